@@ -0,0 +1,333 @@
+"""
+This module benchmarks the S3 API and the sync.
+It starts a local instance of the API backed by a bare git repository and a local
+DvC remote in a temporary folder, uploads Label Studio annotations with PUT, reads
+them back with GET and lists them with ListObjectsV2 at the given concurrency, then
+runs a full sync, an incremental sync after updating and deleting some annotations
+and an unchanged sync, and reports the duration of every stage of the sync.
+The requests are signed with utils/aws_v4_signature, like the requests of Label Studio.
+With --endpoint an already running instance is benchmarked instead, without the syncs.
+
+Run it from the root of the repository (git and dvc must be installed):
+    python -m benchmarks.benchmark --objects 1000 --concurrency 16
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from urllib.parse import quote, urlparse
+from xml.etree import ElementTree
+
+import requests
+
+from utils.aws_v4_signature import get_aws_v4_canonical_request, get_aws_v4_signature
+
+repository_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+region = "us-east-1"
+service = "s3"
+dataset = "data/data.json"
+# the syncs are run by the benchmark, the sync worker of the instance never triggers
+never = str(365 * 24 * 3600)
+
+
+class S3Client:
+
+    def __init__(self, endpoint, access_key_id, secret_access_key):
+        self.endpoint = endpoint.rstrip("/")
+        self.host = urlparse(self.endpoint).netloc
+        self.access_key_id = access_key_id
+        self.secret_access_key = secret_access_key
+        # one connection per thread
+        self.local = threading.local()
+
+    def signed_headers(self, method, path, query, body):
+        now = datetime.now(timezone.utc)
+        amzdate = now.strftime("%Y%m%dT%H%M%SZ")
+        datestamp = now.strftime("%Y%m%d")
+        headers = {"host": self.host, "x-amz-content-sha256": hashlib.sha256(body).hexdigest(), "x-amz-date": amzdate}
+        signed_headers = sorted(headers)
+        # the canonical request is built by the same code that verifies it in the API
+        request = SimpleNamespace(method=method, url=SimpleNamespace(path=path, query=query), headers=headers)
+        canonical_request = get_aws_v4_canonical_request(request, signed_headers)
+        signature = get_aws_v4_signature(
+            self.secret_access_key, canonical_request, datestamp, region, service, amzdate
+        )
+        headers["Authorization"] = (
+            f"AWS4-HMAC-SHA256 Credential={self.access_key_id}/{datestamp}/{region}/{service}/aws4_request, "
+            f"SignedHeaders={';'.join(signed_headers)}, Signature={signature}"
+        )
+        return headers
+
+    def request(self, method, path, query="", body=b""):
+        # returns the response and its latency, signing is not part of the latency
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        headers = self.signed_headers(method, path, query, body)
+        url = f"{self.endpoint}{path}" + (f"?{query}" if query else "")
+        started_at = time.perf_counter()
+        response = session.request(method, url, headers=headers, data=body)
+        # the responses are streamed, reading the body is part of the request
+        response.content
+        latency = time.perf_counter() - started_at
+        if response.status_code >= 300:
+            raise RuntimeError(f"{method} {path}?{query} returned {response.status_code}: {response.text[:200]}")
+        return response, latency
+
+
+def percentile(latencies, q):
+    # nearest-rank percentile of sorted latencies
+    return latencies[max(0, math.ceil(q * len(latencies)) - 1)]
+
+
+def report(operation, latencies, elapsed):
+    latencies = sorted(latencies)
+    print(
+        f"## Benchmark | {operation:<6} {len(latencies):>7} requests {len(latencies) / elapsed:>9.1f} req/s"
+        f" | p50 {percentile(latencies, 0.5) * 1000:8.2f}ms | p99 {percentile(latencies, 0.99) * 1000:8.2f}ms"
+    )
+
+
+def run_requests(operation, send, items, concurrency):
+    # run send on every item with `concurrency` threads, send returns the latencies of the item
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        latencies = [latency for item_latencies in executor.map(send, items) for latency in item_latencies]
+    report(operation, latencies, time.perf_counter() - started_at)
+
+
+def annotation(annotation_id, revision, text_size):
+    # a Label Studio annotation as stored in the target cloud storage
+    return json.dumps({
+        "id": annotation_id,
+        "result": [{"type": "choices", "value": {"choices": [f"label-{revision}"]}}],
+        "task": {"id": annotation_id, "data": {"text": "x" * text_size}},
+    }).encode()
+
+
+def put_objects(client, args, ids, revision):
+    def send(annotation_id):
+        body = annotation(annotation_id, revision, args.text_size)
+        return [client.request("PUT", f"/{args.bucket}/{args.prefix}/{annotation_id}", body=body)[1]]
+
+    run_requests("PUT", send, ids, args.concurrency)
+
+
+def get_objects(client, args, ids):
+    def send(annotation_id):
+        return [client.request("GET", f"/{args.bucket}/{args.prefix}/{annotation_id}")[1]]
+
+    run_requests("GET", send, ids, args.concurrency)
+
+
+def delete_objects(client, args, ids):
+    def send(annotation_id):
+        return [client.request("DELETE", f"/{args.bucket}/{args.prefix}/{annotation_id}")[1]]
+
+    run_requests("DELETE", send, ids, args.concurrency)
+
+
+def list_objects(client, args):
+    # every listing walks all the pages of the prefix, the latency is the one of a page
+    def send(_):
+        latencies = []
+        token = None
+        while True:
+            query = f"list-type=2&max-keys={args.page_size}&prefix={quote(args.prefix + '/', safe='')}"
+            if token is not None:
+                query += f"&continuation-token={quote(token, safe='')}"
+            response, latency = client.request("GET", f"/{args.bucket}", query)
+            latencies.append(latency)
+            root = ElementTree.fromstring(response.content)
+            token = next((e.text for e in root.iter() if e.tag.endswith("NextContinuationToken")), None)
+            if token is None:
+                return latencies
+
+    run_requests("LIST", send, range(args.listings), args.concurrency)
+
+
+def run(command, cwd=None):
+    subprocess.run(command, cwd=cwd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+
+
+def create_git_repo(root):
+    # a bare git repository holding a DvC project that tracks an empty dataset
+    origin = f"{root}/origin.git"
+    work = f"{root}/work"
+    run(["git", "init", "--bare", origin])
+    run(["git", "--git-dir", origin, "symbolic-ref", "HEAD", "refs/heads/main"])
+    run(["git", "init", work])
+    run(["git", "checkout", "-b", "main"], work)
+    run(["git", "config", "user.name", "benchmark"], work)
+    run(["git", "config", "user.email", "benchmark@mlops.com"], work)
+    run(["dvc", "init"], work)
+    os.makedirs(os.path.dirname(f"{work}/{dataset}"))
+    with open(f"{work}/{dataset}", "w") as f:
+        f.write("[]")
+    run(["dvc", "add", dataset], work)
+    run(["git", "add", "-A"], work)
+    run(["git", "commit", "-m", "init"], work)
+    run(["git", "push", origin, "main"], work)
+    return origin
+
+
+def instance_environment(root, origin, access_key_id, secret_access_key, storage_backend, compression):
+    env = dict(os.environ)
+    env.pop("TENANTS_FILE", None)
+    env.update({
+        "AWS_ACCESS_KEY_ID": access_key_id,
+        "AWS_SECRET_ACCESS_KEY": secret_access_key,
+        "S3_DATA_FOLDER": f"{root}/s3/objects",
+        "S3_STORAGE_BACKEND": storage_backend,
+        "S3_COMPRESSION": compression,
+        "GIT_FOLDER": f"{root}/git",
+        "GIT_REPO": f"file://{origin}",
+        "GIT_BRANCH": "main",
+        "GIT_PAT_NAME": "benchmark",
+        "DVC_DATASET": dataset,
+        "DVC_DATASET_FORMAT": "json",
+        "DVC_REMOTE_NAME": "benchmark",
+        "DVC_CLOUD_STORAGE_PROVIDER": "local",
+        "DVC_BUCKET_NAME": f"{root}/remote",
+        "BUNDLE_COUNTDOWN": never,
+        "SYNC_DEBOUNCE_SECONDS": never,
+        "SYNC_MAX_LATENCY_SECONDS": never,
+        "SYNC_MAX_BATCH": never,
+    })
+    os.makedirs(env["S3_DATA_FOLDER"])
+    return env
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_instance(root, env, timeout=120):
+    port = free_port()
+    log = open(f"{root}/instance.log", "wb")
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        cwd=repository_folder, env=env, stdout=log, stderr=subprocess.STDOUT,
+    )
+    endpoint = f"http://127.0.0.1:{port}"
+    # wait until the git repository is cloned
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            break
+        try:
+            if requests.get(f"{endpoint}/readyz").status_code == 200:
+                return process, endpoint
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+    process.kill()
+    with open(f"{root}/instance.log", "r") as f:
+        raise RuntimeError(f"the instance did not get ready:\n{f.read()[-2000:]}")
+
+
+def run_sync(name, physical_data_path):
+    # the sync modules read their configuration from the environment of the instance
+    from utils.packed_store import packed_store
+    from utils.sync import sync_eventually
+    from utils.timing import stage_timings
+
+    if packed_store is not None:
+        # the objects were written by the instance, read its segments again
+        packed_store.load()
+    stage_timings.clear()
+    started_at = time.perf_counter()
+    sync_eventually(os.environ, physical_data_path)
+    elapsed = time.perf_counter() - started_at
+    stages = ", ".join(f"{stage} {duration:.3f}s" for stage, duration in stage_timings.items())
+    return f"## Benchmark | sync {name:<11} {elapsed:8.3f}s | {stages}"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the S3 API and the sync")
+    parser.add_argument("--objects", type=int, default=1000, help="number of annotations uploaded")
+    parser.add_argument("--concurrency", type=int, default=16, help="number of requests in flight")
+    parser.add_argument("--text-size", type=int, default=200, help="size of the text of an annotation")
+    parser.add_argument("--listings", type=int, default=16, help="number of full listings")
+    parser.add_argument("--page-size", type=int, default=1000, help="max-keys of a listing page")
+    parser.add_argument("--changed", type=int, default=10, help="annotations changed and deleted before the incremental sync")
+    parser.add_argument("--storage", choices=["files", "packed"], default="files", help="S3_STORAGE_BACKEND")
+    parser.add_argument("--compression", choices=["none", "gzip", "zstd"], default="none", help="S3_COMPRESSION")
+    parser.add_argument("--bucket", default="benchmark")
+    parser.add_argument("--prefix", default="annotations")
+    parser.add_argument("--endpoint", help="benchmark a running instance instead, the syncs are skipped")
+    parser.add_argument("--access-key-id", default="benchmark")
+    parser.add_argument("--secret-access-key", default="benchmark-secret")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary folder")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    ids = list(range(1, args.objects + 1))
+
+    if args.endpoint:
+        client = S3Client(args.endpoint, args.access_key_id, args.secret_access_key)
+        put_objects(client, args, ids, 0)
+        get_objects(client, args, ids)
+        list_objects(client, args)
+        return
+
+    root = tempfile.mkdtemp(prefix="s3-dvc-sync-benchmark-")
+    process = None
+    results = []
+    try:
+        origin = create_git_repo(root)
+        env = instance_environment(
+            root, origin, args.access_key_id, args.secret_access_key, args.storage, args.compression
+        )
+        process, endpoint = start_instance(root, env)
+        client = S3Client(endpoint, args.access_key_id, args.secret_access_key)
+
+        put_objects(client, args, ids, 0)
+        get_objects(client, args, ids)
+        list_objects(client, args)
+
+        os.environ.update(env)
+        physical_data_path = f"{env['S3_DATA_FOLDER']}/{args.bucket}/{args.prefix}"
+        results.append(run_sync("full", physical_data_path))
+        put_objects(client, args, ids[:args.changed], 1)
+        delete_objects(client, args, ids[-args.changed:])
+        results.append(run_sync("incremental", physical_data_path))
+        results.append(run_sync("unchanged", physical_data_path))
+
+        # save the metadata cache of the syncs now rather than at exit, once the folder is removed
+        from utils.metadata import save_object_metadata
+        save_object_metadata()
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        if args.keep:
+            print(f"## Benchmark | files kept in {root}")
+        else:
+            shutil.rmtree(root, True)
+
+    # the syncs log every stage, the summary is printed at the end
+    for result in results:
+        print(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,127 +1,285 @@
 import os
+import time
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse, Response, PlainTextResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from urllib.parse import parse_qs
 
-from utils.aws import aws_put_object_stream_to_file, aws_list_object_response, aws_get_object_response
-from utils.aws_v4_signature import get_aws_v4_signature, get_aws_signature_arguments
-from utils.git import git_pull, git_commit_push, init_git_repo
-from utils.dvc import dvc_update_dataset_file, dvc_commit_push
-from utils.debounce import debounce
-
-from threading import Thread
+from utils.aws import (
+    aws_put_object_stream_to_file, aws_list_object_response, aws_list_object_v1_response, aws_get_object_response,
+    aws_delete_object, aws_delete_objects, valid_object_path,
+)
+from utils.aws_multipart import (
+    aws_create_multipart_upload, aws_upload_part, aws_complete_multipart_upload, aws_abort_multipart_upload,
+)
+from utils.aws_v4_signature import parse_aws_v4_authorization, verify_aws_v4_signature
+from utils.metrics import (
+    metrics_content, metrics_content_type, observe_request, register_object_cache, register_tenants, span,
+    timed_signature_verification,
+)
+from utils.object_cache import object_cache
+from utils.packed_store import packed_store
+from utils.tenants import load_tenants
 
 from dotenv import load_dotenv
 load_dotenv()
 
-app = FastAPI()
-
-# create a map to store the bundle countdown for each bucket
-bundle_countdown = int(os.getenv("BUNDLE_COUNTDOWN"))
-git_folder = os.getenv("GIT_FOLDER")
-
-init_git_repo()
-
-# we must insire that only one sync is running at a time
-# we do not use mutex because we want to skip the sync request if a previous sync is already running
-sync_lock = False 
-
-@debounce(10) # debounce the sync function for 10 seconds
-def do_one_sync(physical_data_path):
-    # run the sync in a separate thread
-    Thread(target=sync_eventually, args=(physical_data_path,)).start()
-
-# a sync coroutine running in a separate thread
-def sync_eventually(physical_data_path):
-    global sync_lock
-    if sync_lock:
-        print("## Sync Already Running | Skipping...")
-        return
-    sync_lock = True
-    print("## Syncing...")
-    # git pull the repo
-    git_pull()
-    # update the dataset file
-    dvc_update_dataset_file(physical_data_path)
-    # commit and push the changes with dvc
-    dvc_push_response = dvc_commit_push()
-    # check if dvc_push_response contains "Everything is up to date."
-    # if it does, then there is no need to commit and push the changes with git
-    if not "Everything is up to date." in dvc_push_response:
-        # commit and push the changes with git
-        git_commit_push()
-        print("## Sync Done | Changes Committed and Pushed : ", dvc_push_response)
-    else:
-        print("## No Changes | Skipping Git Commit and Push...")
-    sync_lock = False
-    
+# every tenant has its own access key, buckets, git repository and sync worker
+tenants = load_tenants()
+tenants_by_access_key = {tenant.access_key_id: tenant for tenant in tenants}
+register_tenants(tenants)
+register_object_cache(object_cache)
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    # the repositories are cloned in the background, requests are served right away
+    for tenant in tenants:
+        tenant.start()
+    if packed_store is not None:
+        # snapshots and compaction of the packed object store
+        packed_store.start()
+    yield
+
+
+# the documentation routes would shadow the buckets named like them
+app = FastAPI(lifespan=lifespan, docs_url=None, redoc_url=None, openapi_url=None)
+
+# paths served without signature
+public_paths = {"/healthz", "/readyz", "/metrics"}
+
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readyz():
+    # ready once every tenant repository is cloned and syncing
+    status = {tenant.name: "ready" if tenant.ready else "starting" for tenant in tenants}
+    status_code = 200 if all(tenant.ready for tenant in tenants) else 503
+    return JSONResponse(status_code=status_code, content={"tenants": status})
+
+
+@app.get("/metrics")
+async def metrics():
+    return Response(content=metrics_content(), media_type=metrics_content_type)
+
 
 def signature_ok(req: Request):
-    authorization = req.headers['Authorization']
-    request_signature = authorization.split(",")[2].split("=")[1]    
-    aws_access_key_id = authorization.split(",")[0].split("=")[1].split("/")[0]
-    if aws_access_key_id != os.getenv("AWS_ACCESS_KEY_ID"): # implemented but not used in single tenant mode
-        return False
-    aws_secret_access_key, canonical_request, datestamp, aws_region, service, amzdate = get_aws_signature_arguments(req)
-    reversed_signature = get_aws_v4_signature(aws_secret_access_key, canonical_request, datestamp, aws_region, service, amzdate)
-    return request_signature == reversed_signature
-
-# handle all GET, HEAD and PUT requests
+    # returns the tenant of the request if its signature is valid
+    if 'Authorization' not in req.headers:
+        return None
+    # parse the authorization header once
+    authorization = parse_aws_v4_authorization(req.headers['Authorization'])
+    if authorization is None:
+        return None
+    tenant = tenants_by_access_key.get(authorization["access_key_id"])
+    if tenant is None:
+        return None
+    with timed_signature_verification():
+        if not verify_aws_v4_signature(req, authorization, tenant.secret_access_key):
+            return None
+    return tenant
+
+# S3 error codes that are not a 400 Bad Request
+error_status_codes = {"NoSuchUpload": 404}
+
+
+def error_response(e: ValueError):
+    message = str(e)
+    return JSONResponse({"message": message}, status_code=error_status_codes.get(message, 400))
+
+
+def not_implemented():
+    return JSONResponse({"message": "Not Implemented"}, status_code=501)
+
+
+def object_changed(tenant, physical_data_path):
+    # the sync worker of the tenant decides when to sync
+    tenant.sync_worker.notify(physical_data_path)
+
+
+def s3_params(req: Request):
+    # keep blank values, some S3 sub-resources like ?uploads have no value
+    return parse_qs(req.url.query, keep_blank_values=True)
+
+
+def s3_operation(method, bucket, key, params):
+    # name of the S3 operation of a request, used by the metrics
+    if bucket is None:
+        return "Unknown"
+    if key is None:
+        if method == "GET":
+            return "ListObjectsV2" if params.get("list-type", ["1"])[0] == "2" else "ListObjects"
+        if method == "POST" and "delete" in params:
+            return "DeleteObjects"
+        return "HeadBucket" if method == "HEAD" else "Unknown"
+    if "uploadId" in params:
+        return {
+            "PUT": "UploadPart", "POST": "CompleteMultipartUpload", "DELETE": "AbortMultipartUpload",
+        }.get(method, "Unknown")
+    if method == "POST":
+        return "CreateMultipartUpload" if "uploads" in params else "Unknown"
+    return {
+        "GET": "GetObject", "HEAD": "HeadObject", "PUT": "PutObject", "DELETE": "DeleteObject",
+    }.get(method, "Unknown")
+
+
+# authenticate every S3 request, the routes below handle the authorized ones
 @app.middleware("http")
-async def handle_request(req: Request, _):
-    
-    method = req.method
+async def handle_request(req: Request, call_next):
+
+    if req.url.path in public_paths:
+        return await call_next(req)
 
-    if not signature_ok(req):
+    path = req.url.path.split("/")
+    bucket = None
+    key = None
+
+    if len(path) > 1 and path[1] != "":
+        bucket = path[1]
+    if len(path) > 2:
+        key = "/".join(path[2:])
+
+    operation = s3_operation(req.method, bucket, key, s3_params(req))
+    started_at = time.perf_counter()
+    with span(f"s3 {operation}"):
+        response = await authorize_request(req, call_next, bucket, key)
+    observe_request(operation, response.status_code, time.perf_counter() - started_at)
+    return response
+
+
+async def authorize_request(req: Request, call_next, bucket, key):
+    tenant = signature_ok(req)
+    if tenant is None:
+        return JSONResponse(status_code=403, content={"message": "Forbidden"})
+
+    if bucket is None:
+        return not_implemented()
+
+    # owning the bucket only isolates the tenants if the path stays in the bucket folder
+    if not valid_object_path(bucket, key):
+        return JSONResponse(status_code=400, content={"message": "InvalidArgument"})
+
+    if not tenant.owns_bucket(bucket):
         return JSONResponse(status_code=403, content={"message": "Forbidden"})
 
-    if method == 'GET': 
-        
-        path = req.url.path.split("/")
-        params = parse_qs(req.url.query)
-        bucket = None
-
-        if len(path) > 1:
-            bucket = path[1]
-
-        if bucket is None:
-            return JSONResponse({"message": "Not Implemented"}, status_code=501)
-        
-        if len(path) > 2:
-            # GetObject - if the path is not empty, then we are requesting a file
-            key = "/".join(path[2:])
-            return Response(
-                status_code=200, 
-                content=aws_get_object_response(bucket, key), 
-                headers={"Content-Type": "application/octet-stream"}
-                )
-        elif len(path) == 2:
-            # ListObjects - if the path is empty, then we are requesting a list of files
-            return PlainTextResponse(
-                status_code=200, 
-                content=aws_list_object_response(bucket, params), 
-                headers={"Content-Type": "application/xml"}
-                )
-        else:   
-            return JSONResponse({"message": "Not Implemented"}, status_code=501)
-    
-    elif method == 'HEAD':
-        return Response(status_code=200)
-    
-    elif method == 'PUT':
-        global bundle_countdown
+    # the routes find the tenant of the request in its state
+    req.state.tenant = tenant
+    return await call_next(req)
+
+
+# ListObjects and ListObjectsV2
+@app.get("/{bucket}")
+async def list_objects(req: Request, bucket: str):
+    params = s3_params(req)
+    if params.get("list-type", ["1"])[0] == "2":
+        content = await aws_list_object_response(bucket, params)
+    else:
+        content = await aws_list_object_v1_response(bucket, params)
+    if content is None:
+        return JSONResponse({"message": "Invalid continuation token"}, status_code=400)
+    return StreamingResponse(content, status_code=200, media_type="application/xml")
+
+
+# DeleteObjects
+@app.post("/{bucket}")
+async def delete_objects(req: Request, bucket: str):
+    if "delete" not in s3_params(req):
+        return not_implemented()
+    try:
+        changed_folders, content = await aws_delete_objects(req, bucket)
+    except ValueError as e:
+        return error_response(e)
+    for physical_data_path in changed_folders:
+        object_changed(req.state.tenant, physical_data_path)
+    return Response(status_code=200, content=content, media_type="application/xml")
+
+
+# HeadBucket - the middleware already checked that the tenant owns the bucket
+# boto3 head_bucket (used by Label Studio to validate a storage) needs it
+@app.head("/{bucket}")
+async def head_bucket(req: Request, bucket: str):
+    return Response(status_code=200)
+
+
+# HeadObject - declared before GetObject, the GET routes also match HEAD requests
+@app.head("/{bucket}/{key:path}")
+async def head_object(req: Request, bucket: str, key: str):
+    status_code, headers, _ = await aws_get_object_response(bucket, key, req.headers, head=True)
+    return Response(status_code=status_code, headers=headers)
+
+
+# GetObject
+@app.get("/{bucket}/{key:path}")
+async def get_object(req: Request, bucket: str, key: str):
+    status_code, headers, body = await aws_get_object_response(bucket, key, req.headers)
+    if status_code == 404:
+        return JSONResponse({"message": "Not Found"}, status_code=404)
+    if body is None:
+        return Response(status_code=status_code, headers=headers)
+    return StreamingResponse(body, status_code=status_code, headers=headers, media_type="application/octet-stream")
+
+
+# PutObject and UploadPart
+@app.put("/{bucket}/{key:path}")
+async def put_object(req: Request, bucket: str, key: str):
+    params = s3_params(req)
+    try:
+        if "uploadId" in params:
+            # UploadPart - one part of a multipart upload
+            e_tag = await aws_upload_part(
+                req, bucket, key, params["uploadId"][0], params.get("partNumber", [""])[0]
+            )
+            return Response(status_code=200, headers={"ETag": f'"{e_tag}"'})
+
         # save the data from the request to a file
-        physical_data_path, _ = await aws_put_object_stream_to_file(req)
-
-        if bundle_countdown == 0:
-            bundle_countdown = int(os.getenv("BUNDLE_COUNTDOWN"))
-            do_one_sync(physical_data_path)
-
-        # decrement the bundle countdown
-        bundle_countdown -= 1
-                
-        # send FastAPI response status 200
-        return Response(status_code=200)
-            
-    return JSONResponse({"message": "Not Implemented"}, status_code=501)
\ No newline at end of file
+        physical_data_path, _, e_tag = await aws_put_object_stream_to_file(req)
+    except ValueError as e:
+        return error_response(e)
+
+    object_changed(req.state.tenant, physical_data_path)
+    return Response(status_code=200, headers={"ETag": f'"{e_tag}"'})
+
+
+# CreateMultipartUpload and CompleteMultipartUpload
+@app.post("/{bucket}/{key:path}")
+async def post_object(req: Request, bucket: str, key: str):
+    params = s3_params(req)
+    try:
+        if "uploads" in params:
+            # CreateMultipartUpload
+            content = await aws_create_multipart_upload(bucket, key)
+            return Response(status_code=200, content=content, media_type="application/xml")
+        if "uploadId" in params:
+            # CompleteMultipartUpload
+            physical_data_path, content = await aws_complete_multipart_upload(
+                req, bucket, key, params["uploadId"][0]
+            )
+            object_changed(req.state.tenant, physical_data_path)
+            return Response(status_code=200, content=content, media_type="application/xml")
+    except ValueError as e:
+        return error_response(e)
+    return not_implemented()
+
+
+# DeleteObject and AbortMultipartUpload
+@app.delete("/{bucket}/{key:path}")
+async def delete_object(req: Request, bucket: str, key: str):
+    params = s3_params(req)
+    if "uploadId" in params:
+        # AbortMultipartUpload
+        try:
+            await aws_abort_multipart_upload(bucket, key, params["uploadId"][0])
+        except ValueError as e:
+            return error_response(e)
+        return Response(status_code=204)
+
+    # DeleteObject - deleting a missing object succeeds, like S3
+    physical_data_path = await aws_delete_object(bucket, key)
+    if physical_data_path is not None:
+        object_changed(req.state.tenant, physical_data_path)
+    return Response(status_code=204)
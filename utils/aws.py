@@ -1,20 +1,43 @@
 import os
 
-from urllib.parse import urlparse, parse_qs
-from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+from email.utils import formatdate, parsedate_to_datetime
+from stat import S_ISREG
+import base64
 import datetime 
 import hashlib
-import math
+import tempfile
+from xml.etree import ElementTree
+
+from utils.compression import (
+    ObjectWriter, compression, object_encoding, object_header, open_object, read_stored_object,
+)
+from utils.files import data_folder
+from utils.io_pool import iterate_io, run_io
+from utils.metadata import delete_object_metadata, get_object_metadata, put_object_metadata
+from utils.key_index import add_key, list_keys, remove_key, upload_temp_prefix
+from utils.object_cache import CachedObject, object_cache
+from utils.packed_store import packed_store
 
 from dotenv import load_dotenv
 load_dotenv()
 
-data_folder = os.getenv("S3_DATA_FOLDER")
 
 def physical_path(relative):
     return f"{data_folder}/{relative}"
 
 
+def valid_object_path(bucket, key=None):
+    # the bucket and the key are joined onto the data folder, a "." or ".." segment (or an
+    # empty one) could reach the objects of another bucket or any file of the process
+    for part in [bucket] if key is None else [bucket, key]:
+        if "\0" in part:
+            return False
+        if any(segment in ("", ".", "..") for segment in part.split("/")):
+            return False
+    return "/" not in bucket
+
+
 def create_folder_if_not_exist(relative):
     p_path = physical_path(relative)
     if not os.path.exists(p_path):
@@ -22,118 +45,418 @@ def create_folder_if_not_exist(relative):
     return p_path
 
 
-def aws_get_object_response(bucket, key):
-    # Read the file from the /data directory
+# size of the chunks read from disk when streaming an object
+chunk_size = 64 * 1024
+
+
+def aws_parse_range(range_header, size):
+    # parse a single "bytes=start-end" range, return (start, end) inclusive,
+    # None if the range should be ignored and False if it is not satisfiable
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    start, _, end = range_header[len("bytes="):].strip().partition("-")
+    try:
+        if start == "":
+            # suffix range, the last N bytes
+            suffix = int(end)
+            if suffix == 0:
+                return False
+            return max(size - suffix, 0), size - 1
+        start = int(start)
+        end = int(end) if end != "" else size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        return False
+    if end < start:
+        return None
+    return start, min(end, size - 1)
+
+
+def aws_etag_matches(condition, e_tag):
+    # compare an If-Match/If-None-Match header with the object ETag
+    for candidate in condition.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == "*" or candidate.strip('"') == e_tag:
+            return True
+    return False
+
+
+def aws_modified_since(condition, last_modified):
+    # compare an If-Modified-Since/If-Unmodified-Since header with the object mtime
+    try:
+        since = parsedate_to_datetime(condition).timestamp()
+    except (TypeError, ValueError):
+        return None
+    # http dates have a one second resolution
+    return int(last_modified) > since
+
+
+def aws_accepted_encodings(accept_encoding):
+    # the content codings of an Accept-Encoding header, "gzip;q=0" refuses gzip
+    encodings = set()
+    for item in accept_encoding.split(","):
+        coding, _, parameters = item.partition(";")
+        parameters = parameters.replace(" ", "")
+        if parameters.startswith("q="):
+            try:
+                if float(parameters[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        coding = coding.strip().lower()
+        # an empty header (botocore sends none) accepts no coding
+        if coding:
+            encodings.add(coding)
+    return encodings
+
+
+async def aws_iter_object(ppath, offset, stored_length, start, length, decode=True):
+    # stream a byte range of an object without blocking the event loop, the range is in the
+    # bytes of the object, or in its encoded bytes if decode is False
+    reader = await run_io("read", open_object, ppath, offset, stored_length, decode)
+    try:
+        if start > 0:
+            await run_io("read", reader.skip, start)
+        while length > 0:
+            chunk = await run_io("read", reader.read, min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        reader.close()
+
+
+async def aws_iter_bytes(data):
+    yield data
+
+
+def object_info(bucket, key):
+    # returns the size, the mtime and the ETag of an object, the file holding it, the
+    # offset of the object in that file and its stored length, or None if the object
+    # does not exist
+    if packed_store is not None:
+        record = packed_store.get(bucket, key)
+        if record is None:
+            return None
+        return (
+            record.size, record.mtime_ns / 1e9, record.e_tag, packed_store.segment_path(record.segment),
+            record.offset, record.length,
+        )
+
     ppath = physical_path(f"{bucket}/{key}")
-    with open(ppath, "rb") as file:
-        file_content = file.read()
-
-    # Return the file content
-    return file_content
-
-def aws_list_object_response(bucket, params):
-    # Parse the URL to extract the bucket and search parameters
-    # Get the prefix and max-keys search parameters
-    
-    prefix = ""
-    if "prefix" in params:
-        prefix = params.get("prefix")[0]
-    
-    max_keys = "1000"
-    if "max-keys" in params:
-        max_keys = params.get("max-keys")[0]
-
-    # Read files from the /data directory
-    physical_path = create_folder_if_not_exist(f"{bucket}/{prefix}")
-    files = os.listdir(physical_path)
-
-    # Create the XML response
-    root = ElementTree.Element("ListBucketResult", {"xmlns": "http://s3.amazonaws.com/doc/2006-03-01/"})
-    ElementTree.SubElement(root, "Name").text = bucket
-    ElementTree.SubElement(root, "Prefix").text = prefix
-    ElementTree.SubElement(root, "KeyCount").text = str(len(files))
-    ElementTree.SubElement(root, "MaxKeys").text = max_keys
-    ElementTree.SubElement(root, "IsTruncated").text = "false"
+    try:
+        stat = os.stat(ppath)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    if not S_ISREG(stat.st_mode):
+        return None
+    size, e_tag = get_object_metadata(ppath, stat)
+    return size, stat.st_mtime, e_tag, ppath, 0, stat.st_size
+
+
+# GetObject and HeadObject
+# returns the status code, the response headers and an async iterator over the body,
+# the body is always None for a HEAD request
+async def aws_get_object_response(bucket, key, headers=None, head=False):
+    headers = headers or {}
+    # a hot object is served from memory
+    cached = object_cache.get(bucket, key)
+    if cached is not None:
+        size, mtime, e_tag = len(cached.data), cached.mtime, cached.e_tag
+    else:
+        writes = object_cache.writes
+        info = await run_io("read", object_info, bucket, key)
+        if info is None:
+            return 404, {}, None
+        size, mtime, e_tag, ppath, offset, stored_length = info
+
+    response_headers = {
+        "ETag": f'"{e_tag}"',
+        "Last-Modified": formatdate(mtime, usegmt=True),
+        "Accept-Ranges": "bytes",
+        "Content-Type": "application/octet-stream",
+    }
+
+    # conditional requests, see https://www.rfc-editor.org/rfc/rfc9110#section-13.2.2
+    if "if-match" in headers and not aws_etag_matches(headers["if-match"], e_tag):
+        return 412, response_headers, None
+    if "if-match" not in headers and "if-unmodified-since" in headers:
+        if aws_modified_since(headers["if-unmodified-since"], mtime):
+            return 412, response_headers, None
+    if "if-none-match" in headers:
+        if aws_etag_matches(headers["if-none-match"], e_tag):
+            return 304, response_headers, None
+    elif "if-modified-since" in headers:
+        if aws_modified_since(headers["if-modified-since"], mtime) is False:
+            return 304, response_headers, None
+
+    byte_range = aws_parse_range(headers.get("range"), size)
+    if byte_range is False:
+        response_headers["Content-Range"] = f"bytes */{size}"
+        return 416, response_headers, None
+
+    if cached is None and not head and object_cache.cacheable(size):
+        # read the whole object, the next requests are served from memory
+        data, encoded, encoding = await run_io("read", read_stored_object, ppath, offset, stored_length)
+        cached = CachedObject(data, mtime, e_tag, encoded, encoding)
+        # unless a write changed the object since it was found
+        if object_cache.writes == writes:
+            object_cache.put(bucket, key, cached)
+
+    if byte_range is None:
+        if compression != "none":
+            response_headers["Vary"] = "Accept-Encoding"
+        accepted = aws_accepted_encodings(headers.get("accept-encoding", ""))
+        if accepted - {"identity"}:
+            # a compressed object is served as it is stored to the clients accepting its codec
+            if cached is not None:
+                encoding = cached.encoding
+            else:
+                encoding = await run_io("read", object_encoding, ppath, offset, stored_length)
+            if encoding is not None and (encoding in accepted or "*" in accepted):
+                response_headers["Vary"] = "Accept-Encoding"
+                response_headers["Content-Encoding"] = encoding
+                if cached is not None:
+                    response_headers["Content-Length"] = str(len(cached.encoded))
+                    return 200, response_headers, None if head else aws_iter_bytes(cached.encoded)
+                response_headers["Content-Length"] = str(stored_length - object_header.size)
+                return 200, response_headers, None if head else aws_iter_object(
+                    ppath, offset, stored_length, 0, stored_length - object_header.size, decode=False
+                )
+        response_headers["Content-Length"] = str(size)
+        if head:
+            return 200, response_headers, None
+        if cached is not None:
+            return 200, response_headers, aws_iter_bytes(cached.data)
+        return 200, response_headers, aws_iter_object(ppath, offset, stored_length, 0, size)
+
+    start, end = byte_range
+    response_headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    response_headers["Content-Length"] = str(end - start + 1)
+    if head:
+        return 206, response_headers, None
+    if cached is not None:
+        return 206, response_headers, aws_iter_bytes(cached.data[start:end + 1])
+    return 206, response_headers, aws_iter_object(ppath, offset, stored_length, start, end - start + 1)
+
+
+def aws_list_params(params):
+    # Get the prefix, delimiter and max-keys search parameters
+    prefix = params.get("prefix", [""])[0]
+    delimiter = params.get("delimiter", [""])[0]
+    try:
+        max_keys = min(int(params.get("max-keys", ["1000"])[0]), 1000)
+    except ValueError:
+        max_keys = 1000
+    return prefix, delimiter, max(max_keys, 0)
+
+
+def aws_list_objects(bucket, prefix, start_after, delimiter, max_keys):
+    # one page of the ordered key index
+    if packed_store is None:
+        create_folder_if_not_exist(bucket)
+    return list_keys(bucket, prefix, start_after, delimiter, max_keys)
+
+
+def xml_element(tag, text):
+    return f"<{tag}>{escape(text)}</{tag}>"
+
+
+def xml_document(root, elements):
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<{root} xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+        + "".join(xml_element(tag, text) for tag, text in elements)
+        + f"</{root}>"
+    )
+
+
+def aws_list_xml(bucket, header, keys, common_prefixes, buffer_size=64):
+    # generate the ListBucketResult document piece by piece, the metadata of
+    # each key is read only when its element is written
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+    yield "".join(xml_element(tag, text) for tag, text in header)
 
     # Add the files to the XML response
-    for file in files:
-        content = ElementTree.SubElement(root, "Contents")
-        last_modified_iso = datetime.datetime.fromtimestamp(os.path.getmtime(f"{physical_path}/{file}")).isoformat()
-        file_size = os.path.getsize(f"{physical_path}/{file}")
-        e_tag = aws_s3_etag(f"{physical_path}/{file}")
-        ElementTree.SubElement(content, "Key").text = file
-        ElementTree.SubElement(content, "Size").text = str(file_size)
-        ElementTree.SubElement(content, "LastModified").text = last_modified_iso
-        ElementTree.SubElement(content, "ETag").text = e_tag
-        ElementTree.SubElement(content, "StorageClass").text = "STANDARD"
-
-    # Return the XML response
-    return ElementTree.tostring(root, encoding="utf-8", method="xml").decode("utf-8")
-
-
-def aws_list_object_v1_response(req_url, query_string):
-    # Parse the URL to extract the bucket and search parameters
-    url_parsed = urlparse(req_url)
-    bucket = url_parsed.path.split("/")[0]
-    params = parse_qs(query_string)
-
-    # check if its a list object v1 request
-    if "list-type" in params and params["list-type"][0] != "1":
+    buffer = []
+    for key in keys:
+        info = object_info(bucket, key)
+        if info is None:
+            # deleted since the page was read
+            continue
+        size, mtime, e_tag, _, _, _ = info
+        last_modified_iso = datetime.datetime.fromtimestamp(mtime).isoformat()
+        buffer.append(
+            "<Contents>"
+            + xml_element("Key", key)
+            + xml_element("Size", str(size))
+            + xml_element("LastModified", last_modified_iso)
+            + xml_element("ETag", e_tag)
+            + xml_element("StorageClass", "STANDARD")
+            + "</Contents>"
+        )
+        if len(buffer) >= buffer_size:
+            yield "".join(buffer)
+            buffer.clear()
+
+    for common_prefix in common_prefixes:
+        buffer.append("<CommonPrefixes>" + xml_element("Prefix", common_prefix) + "</CommonPrefixes>")
+
+    buffer.append("</ListBucketResult>")
+    yield "".join(buffer)
+
+
+def encode_continuation_token(marker):
+    return base64.urlsafe_b64encode(marker.encode("utf-8")).decode("ascii")
+
+
+def decode_continuation_token(token):
+    # urlsafe_b64decode drops the invalid characters, a malformed token would list the first page
+    try:
+        return base64.b64decode(token.encode("ascii"), altchars=b"-_", validate=True).decode("utf-8")
+    except (ValueError, UnicodeError):
         return None
 
-    # Get the prefix and max-keys search parameters
-    prefix = params.get("prefix")[0]
-    max_keys = params.get("max-keys")[0]
 
-    # Read files from the /data directory
-    physical_path = create_folder_if_not_exist(f"{bucket}/{prefix}")
-    files = os.listdir(physical_path)
+# ListObjectsV2
+# returns an async generator of the XML response or None if the continuation token is invalid
+async def aws_list_object_response(bucket, params):
+    prefix, delimiter, max_keys = aws_list_params(params)
+    start_after = params.get("start-after", [""])[0]
+    continuation_token = params.get("continuation-token", [None])[0]
 
-    # Create the XML response
-    root = ElementTree.Element("ListBucketResult", {"xmlns": "http://s3.amazonaws.com/doc/2006-03-01/"})
-    ElementTree.SubElement(root, "Name").text = bucket
-    ElementTree.SubElement(root, "Prefix").text = prefix
-    ElementTree.SubElement(root, "KeyCount").text = str(len(files))
-    ElementTree.SubElement(root, "MaxKeys").text = max_keys
-    ElementTree.SubElement(root, "IsTruncated").text = "false"
+    # the continuation token takes precedence over start-after
+    marker = start_after
+    if continuation_token is not None:
+        marker = decode_continuation_token(continuation_token)
+        if marker is None:
+            return None
+
+    keys, common_prefixes, is_truncated, next_marker = await run_io(
+        "list", aws_list_objects, bucket, prefix, marker, delimiter, max_keys
+    )
+
+    header = [("Name", bucket), ("Prefix", prefix)]
+    if delimiter:
+        header.append(("Delimiter", delimiter))
+    if start_after:
+        header.append(("StartAfter", start_after))
+    if continuation_token is not None:
+        header.append(("ContinuationToken", continuation_token))
+    header.append(("KeyCount", str(len(keys) + len(common_prefixes))))
+    header.append(("MaxKeys", str(max_keys)))
+    header.append(("IsTruncated", "true" if is_truncated else "false"))
+    if is_truncated:
+        header.append(("NextContinuationToken", encode_continuation_token(next_marker)))
+
+    return iterate_io("list", aws_list_xml(bucket, header, keys, common_prefixes))
+
+
+# ListObjects (V1)
+# returns an async generator of the XML response
+async def aws_list_object_v1_response(bucket, params):
+    prefix, delimiter, max_keys = aws_list_params(params)
+    marker = params.get("marker", [""])[0]
+
+    keys, common_prefixes, is_truncated, next_marker = await run_io(
+        "list", aws_list_objects, bucket, prefix, marker, delimiter, max_keys
+    )
+
+    header = [("Name", bucket), ("Prefix", prefix), ("Marker", marker)]
+    if delimiter:
+        header.append(("Delimiter", delimiter))
+    header.append(("MaxKeys", str(max_keys)))
+    header.append(("IsTruncated", "true" if is_truncated else "false"))
+    if is_truncated:
+        header.append(("NextMarker", next_marker))
+
+    return iterate_io("list", aws_list_xml(bucket, header, keys, common_prefixes))
+
+
+def aws_multipart_etag(part_digests):
+    # the ETag of a multipart object is the MD5 of the concatenated binary MD5 of its parts
+    return f"{hashlib.md5(b''.join(part_digests)).hexdigest()}-{len(part_digests)}"
+
+
+def create_upload_temp_file(folder):
+    fd, temp_path = tempfile.mkstemp(dir=folder, prefix=upload_temp_prefix)
+    # mkstemp creates the file readable by its owner only
+    os.chmod(temp_path, 0o644)
+    return os.fdopen(fd, "wb"), temp_path
+
+
+def remove_upload_temp_file(temp_path):
+    if os.path.exists(temp_path):
+        os.unlink(temp_path)
+
+
+def write_hashed_chunk(file, hashes, chunk):
+    for h in hashes:
+        h.update(chunk)
+    file.write(chunk)
 
-    # Add the files to the XML response
-    for file in files:
-        content = ElementTree.SubElement(root, "Contents")
-        last_modified_iso = datetime.datetime.fromtimestamp(os.path.getmtime(f"{physical_path}/{file}")).isoformat()
-        file_size = os.path.getsize(f"{physical_path}/{file}")
-        e_tag = aws_s3_etag(f"{physical_path}/{file}")
-        ElementTree.SubElement(content, "Key").text = file
-        ElementTree.SubElement(content, "Size").text = str(file_size)
-        ElementTree.SubElement(content, "LastModified").text = last_modified_iso
-        ElementTree.SubElement(content, "ETag").text = e_tag
-        ElementTree.SubElement(content, "StorageClass").text = "STANDARD"
-
-    # Return the XML response
-    return ElementTree.tostring(root, encoding="utf-8", method="xml").decode("utf-8")
-
-# transform md5 to python
-def md5(data):
-    return hashlib.md5(data).hexdigest()
-
-# transform awsS3Etag to python
-def aws_s3_etag(file_path, part_size_bytes = 0):
-    file = open(file_path, 'rb').read()
-    if part_size_bytes == 0:
-        return md5(file)
-    size = os.stat(file_path).st_size
-    part_count = math.floor(size / part_size_bytes)
-    file_desc = open(file_path, 'rb')
-    str_md5 = ''
-    for i in range(part_count):
-        skip = i * part_size_bytes
-        left = size - skip
-        to_read = min(left, part_size_bytes)
-        buffer = file_desc.read(to_read)
-        str_md5 += md5(buffer)
-    file_desc.close()
-    complete_md5 = md5(str_md5.encode('utf-8'))
-    return f"{complete_md5}-{part_count}"
+
+async def aws_stream_request(req, file):
+    # stream the request body to file while hashing it and check the digests sent by the client
+    # returns the hex MD5 of the body (the S3 ETag)
+    md5_hash = hashlib.md5()
+    sha256_hash = hashlib.sha256()
+    async for chunk in req.stream():
+        if chunk:
+            await run_io("write", write_hashed_chunk, file, (md5_hash, sha256_hash), chunk)
+
+    # x-amz-content-sha256 is either the hex digest of the payload or a keyword like UNSIGNED-PAYLOAD
+    content_sha256 = req.headers.get("x-amz-content-sha256", "")
+    if len(content_sha256) == 64 and content_sha256 != sha256_hash.hexdigest():
+        raise ValueError("XAmzContentSHA256Mismatch")
+    content_md5 = req.headers.get("content-md5")
+    if content_md5 is not None and content_md5 != base64.b64encode(md5_hash.digest()).decode():
+        raise ValueError("BadDigest")
+
+    return md5_hash.hexdigest()
+
+
+async def aws_stream_request_to_file(req, file_path, encode=True, keep=0):
+    # stream the request body to a temporary file next to file_path, then atomically
+    # rename it so readers never see a partially written object
+    # the body is stored in the format of S3_COMPRESSION, or as is if encode is False
+    # returns the hex MD5 of the body (the S3 ETag), its size and its ObjectWriter, which kept
+    # the body if it is at most keep bytes, or None if encode is False
+    file, temp_path = await run_io("write", create_upload_temp_file, os.path.dirname(file_path))
+    try:
+        with file:
+            writer = ObjectWriter(file, keep=keep) if encode else file
+            e_tag = await aws_stream_request(req, writer)
+            if encode:
+                await run_io("write", writer.finish)
+            size = writer.size if encode else file.tell()
+        await run_io("write", os.replace, temp_path, file_path)
+    except BaseException:
+        remove_upload_temp_file(temp_path)
+        raise
+
+    return e_tag, size, writer if encode else None
+
+
+# bodies up to this size are buffered in memory before being appended to the packed store
+spool_max_size = 1024 * 1024
+
+
+async def aws_stream_request_to_packed_store(req, bucket, key, keep=0):
+    # the body is appended once it is complete and its digests are checked
+    # returns the ETag, the record of the object and its ObjectWriter, which kept the body
+    # if it is at most keep bytes
+    with tempfile.SpooledTemporaryFile(max_size=spool_max_size) as spool:
+        writer = ObjectWriter(spool, keep=keep)
+        e_tag = await aws_stream_request(req, writer)
+        length = await run_io("write", writer.finish)
+        spool.seek(0)
+        record = await run_io("write", packed_store.put, bucket, key, spool, length, e_tag, writer.size)
+    return e_tag, record, writer
 
 
 # PutObject 
@@ -142,13 +465,106 @@ async def aws_put_object_stream_to_file(req):
     url_parts = req.url.path.split("/")
     key = url_parts[-1]
     relative_path = "/".join(url_parts[1:-1])
-    p_path = create_folder_if_not_exist(relative_path)
+    bucket, object_key = url_parts[1], "/".join(url_parts[2:])
+    # the objects small enough for the cache are kept in memory while they are written
+    keep = object_cache.max_object_size if object_cache.enabled else 0
+
+    async with object_cache.writing(bucket, object_key):
+        if packed_store is not None:
+            # the folder is never created, it only names the annotations of the object for the sync
+            p_path = physical_path(relative_path)
+            e_tag, record, writer = await aws_stream_request_to_packed_store(req, bucket, object_key, keep)
+            mtime = record.mtime_ns / 1e9
+        else:
+            p_path = await run_io("write", create_folder_if_not_exist, relative_path)
+            # stream the body to the file, the ETag is computed on the fly
+            e_tag, size, writer = await aws_stream_request_to_file(req, f"{p_path}/{key}", keep=keep)
+            stat = await run_io("write", put_object_metadata, f"{p_path}/{key}", e_tag, None, size)
+            mtime = stat.st_mtime
+        await run_io("write", add_key, bucket, object_key)
+        data = writer.data
+        cached = None if data is None else CachedObject(data, mtime, e_tag, writer.encoded, writer.encoding)
+        object_cache.put(bucket, object_key, cached)
+    return p_path, key, e_tag
+
+
+def delete_object(bucket, key):
+    # returns the physical folder of the deleted object or None if it did not exist
+    ppath = physical_path(f"{bucket}/{key}")
+    if packed_store is not None:
+        if not packed_store.delete(bucket, key):
+            return None
+    else:
+        try:
+            os.unlink(ppath)
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+            return None
+        delete_object_metadata(ppath)
+    remove_key(bucket, key)
+    return os.path.dirname(ppath)
+
+
+# DeleteObject
+# REQUEST DELETE /TestBucket/Lev1/Lev2/1
+# returns the physical folder of the deleted object or None if it did not exist
+async def aws_delete_object(bucket, key):
+    async with object_cache.writing(bucket, key):
+        p_path = await run_io("write", delete_object, bucket, key)
+        object_cache.invalidate(bucket, key)
+    return p_path
+
+
+# S3 limits a DeleteObjects request to 1000 keys
+max_delete_keys = 1000
+
+
+def parse_delete_objects(body):
+    # <Delete><Quiet>true</Quiet><Object><Key>...</Key></Object>...</Delete>
+    # returns the keys and whether only the errors are reported
+    try:
+        root = ElementTree.fromstring(body)
+    except ElementTree.ParseError:
+        raise ValueError("MalformedXML")
+    keys = []
+    quiet = False
+    for element in root:
+        if element.tag.endswith("Quiet"):
+            quiet = (element.text or "").strip().lower() == "true"
+        elif element.tag.endswith("Object"):
+            key = next((child.text for child in element if child.tag.endswith("Key")), None)
+            if not key:
+                raise ValueError("MalformedXML")
+            keys.append(key)
+    if not keys or len(keys) > max_delete_keys:
+        raise ValueError("MalformedXML")
+    return keys, quiet
+
 
-    # read the stream and write to file
-    body = await req.body()
-    with open(f"{p_path}/{key}", "wb") as file:
-        file.write(body)
-        
+# DeleteObjects
+# REQUEST POST /TestBucket?delete
+# returns the physical folders of the deleted objects and the XML response
+async def aws_delete_objects(req, bucket):
+    keys, quiet = parse_delete_objects(await req.body())
+    changed_folders = set()
+    results = []
+    for key in keys:
+        if not valid_object_path(bucket, key):
+            results.append(
+                "<Error>" + xml_element("Key", key) + xml_element("Code", "InvalidArgument")
+                + xml_element("Message", "Invalid key") + "</Error>"
+            )
+            continue
+        p_path = await aws_delete_object(bucket, key)
+        if p_path is not None:
+            changed_folders.add(p_path)
+        if not quiet:
+            results.append(f"<Deleted>{xml_element('Key', key)}</Deleted>")
 
-    file.close()
-    return p_path, key
\ No newline at end of file
+    # deleting a missing key is a success, like S3, quiet mode only reports the errors
+    content = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<DeleteResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+        + "".join(results)
+        + "</DeleteResult>"
+    )
+    return changed_folders, content
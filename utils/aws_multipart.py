@@ -0,0 +1,191 @@
+"""
+This module implements the S3 multipart upload API:
+CreateMultipartUpload, UploadPart, CompleteMultipartUpload and AbortMultipartUpload.
+The parts are streamed to a staging folder, one folder per upload, so they can be
+uploaded in parallel. On completion they are concatenated into the object, which is
+compressed like the objects of PutObject (see utils/compression.py).
+The details of the API can be found here:
+https://docs.aws.amazon.com/AmazonS3/latest/userguide/mpuoverview.html
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from xml.etree import ElementTree
+
+from utils.aws import (
+    aws_multipart_etag, aws_stream_request_to_file, create_folder_if_not_exist, create_upload_temp_file,
+    physical_path, remove_upload_temp_file, xml_document,
+)
+from utils.compression import ObjectWriter
+from utils.files import storage_path
+from utils.io_pool import run_io
+from utils.key_index import add_key
+from utils.object_cache import object_cache
+from utils.packed_store import packed_store
+from utils.metadata import put_object_metadata
+
+from dotenv import load_dotenv
+load_dotenv()
+
+multipart_folder = os.getenv("S3_MULTIPART_FOLDER", storage_path("multipart"))
+
+max_part_number = 10000
+
+
+def upload_folder(upload_id):
+    # upload ids are generated by us, anything else can not be a valid upload
+    try:
+        uuid.UUID(hex=upload_id)
+    except ValueError:
+        raise ValueError("NoSuchUpload")
+    return f"{multipart_folder}/{upload_id}"
+
+
+def load_upload(upload_id, bucket, key):
+    folder = upload_folder(upload_id)
+    try:
+        with open(f"{folder}/upload.json", "r") as f:
+            upload = json.load(f)
+    except FileNotFoundError:
+        raise ValueError("NoSuchUpload")
+    if upload["bucket"] != bucket or upload["key"] != key:
+        raise ValueError("NoSuchUpload")
+    return folder
+
+
+def create_upload(upload_id, bucket, key):
+    folder = upload_folder(upload_id)
+    os.makedirs(folder)
+    with open(f"{folder}/upload.json", "w") as f:
+        json.dump({"bucket": bucket, "key": key}, f)
+
+
+# CreateMultipartUpload
+# REQUEST POST /TestBucket/Lev1/Lev2/1?uploads
+async def aws_create_multipart_upload(bucket, key):
+    upload_id = uuid.uuid4().hex
+    await run_io("write", create_upload, upload_id, bucket, key)
+
+    return xml_document("InitiateMultipartUploadResult", [("Bucket", bucket), ("Key", key), ("UploadId", upload_id)])
+
+
+# UploadPart
+# REQUEST PUT /TestBucket/Lev1/Lev2/1?partNumber=1&uploadId=...
+async def aws_upload_part(req, bucket, key, upload_id, part_number):
+    folder = await run_io("write", load_upload, upload_id, bucket, key)
+    try:
+        part_number = int(part_number)
+    except ValueError:
+        raise ValueError("InvalidArgument")
+    if not 1 <= part_number <= max_part_number:
+        raise ValueError("InvalidArgument")
+
+    # a part uploaded twice replaces the previous one atomically, the parts are stored as is
+    e_tag, _, _ = await aws_stream_request_to_file(req, f"{folder}/{part_number:05d}", encode=False)
+    return e_tag
+
+
+def parse_complete_multipart_upload(body):
+    # <CompleteMultipartUpload><Part><PartNumber>1</PartNumber><ETag>"..."</ETag></Part>...</CompleteMultipartUpload>
+    try:
+        root = ElementTree.fromstring(body)
+    except ElementTree.ParseError:
+        raise ValueError("MalformedXML")
+    parts = []
+    for part in root.iter():
+        if not part.tag.endswith("Part"):
+            continue
+        part_number = e_tag = None
+        for child in part:
+            if child.tag.endswith("PartNumber"):
+                try:
+                    part_number = int(child.text)
+                except (TypeError, ValueError):
+                    raise ValueError("MalformedXML")
+            elif child.tag.endswith("ETag"):
+                e_tag = (child.text or "").strip().strip('"')
+                if not e_tag:
+                    raise ValueError("MalformedXML")
+        if part_number is None or e_tag is None:
+            raise ValueError("MalformedXML")
+        parts.append((part_number, e_tag))
+
+    if not parts:
+        raise ValueError("MalformedXML")
+    if [part_number for part_number, _ in parts] != sorted({part_number for part_number, _ in parts}):
+        raise ValueError("InvalidPartOrder")
+    return parts
+
+
+def concatenate_parts(folder, parts, file_path, chunk_size=1024 * 1024):
+    # concatenate the parts into a temporary file next to file_path, check the MD5 of
+    # every part on the way and atomically rename the result, returns the ETag and the
+    # size of the object
+    part_digests = []
+    file, temp_path = create_upload_temp_file(os.path.dirname(file_path))
+    try:
+        with file:
+            w_stream = ObjectWriter(file)
+            for part_number, e_tag in parts:
+                part_hash = hashlib.md5()
+                try:
+                    r_stream = open(f"{folder}/{part_number:05d}", "rb")
+                except FileNotFoundError:
+                    raise ValueError("InvalidPart")
+                with r_stream:
+                    for chunk in iter(lambda: r_stream.read(chunk_size), b""):
+                        part_hash.update(chunk)
+                        w_stream.write(chunk)
+                if part_hash.hexdigest() != e_tag:
+                    raise ValueError("InvalidPart")
+                part_digests.append(part_hash.digest())
+            w_stream.finish()
+        os.replace(temp_path, file_path)
+    except BaseException:
+        remove_upload_temp_file(temp_path)
+        raise
+
+    return aws_multipart_etag(part_digests), w_stream.size
+
+
+# CompleteMultipartUpload
+# REQUEST POST /TestBucket/Lev1/Lev2/1?uploadId=...
+# returns the physical folder of the object and the XML response
+async def aws_complete_multipart_upload(req, bucket, key, upload_id):
+    folder = await run_io("write", load_upload, upload_id, bucket, key)
+    parts = parse_complete_multipart_upload(await req.body())
+
+    async with object_cache.writing(bucket, key):
+        if packed_store is not None:
+            # concatenate the parts in the upload folder and append the object to the packed store
+            p_path = physical_path(os.path.dirname(f"{bucket}/{key}"))
+            e_tag, size = await run_io("write", concatenate_parts, folder, parts, f"{folder}/object")
+            await run_io("write", packed_store.put_file, bucket, key, f"{folder}/object", e_tag, size)
+        else:
+            ppath = physical_path(f"{bucket}/{key}")
+            p_path = await run_io("write", create_folder_if_not_exist, os.path.dirname(f"{bucket}/{key}"))
+            e_tag, size = await run_io("write", concatenate_parts, folder, parts, ppath)
+            await run_io("write", put_object_metadata, ppath, e_tag, None, size)
+        await run_io("write", add_key, bucket, key)
+        # the object is cached again when it is read
+        object_cache.invalidate(bucket, key)
+    await run_io("write", shutil.rmtree, folder, True)
+
+    return p_path, xml_document(
+        "CompleteMultipartUploadResult",
+        [("Location", f"/{bucket}/{key}"), ("Bucket", bucket), ("Key", key), ("ETag", f'"{e_tag}"')],
+    )
+
+
+def abort_upload(upload_id, bucket, key):
+    folder = load_upload(upload_id, bucket, key)
+    shutil.rmtree(folder, True)
+
+
+# AbortMultipartUpload
+# REQUEST DELETE /TestBucket/Lev1/Lev2/1?uploadId=...
+async def aws_abort_multipart_upload(bucket, key, upload_id):
+    await run_io("write", abort_upload, upload_id, bucket, key)
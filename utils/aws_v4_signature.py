@@ -8,11 +8,16 @@ https://docs.aws.amazon.com/AmazonS3/latest/API/sig-v4-header-based-auth.html
 import os
 import hmac
 import hashlib
+from functools import lru_cache
+from urllib.parse import quote, unquote
 
 def sign(key, msg):
     # from https://docs.aws.amazon.com/general/latest/gr/sigv4-signed-request-examples.html
     return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
 
+# the signing key only changes per secret, date, region and service, deriving it takes
+# four HMACs so the most recent ones are kept
+@lru_cache(maxsize=int(os.getenv("AWS_SIGNING_KEY_CACHE_SIZE", "128")))
 def get_aws_v4_signature_key(key, datestamp, region, service):
     #  from https://docs.aws.amazon.com/general/latest/gr/sigv4-signed-request-examples.html
     key_date = sign(('AWS4' + key).encode('utf-8'), datestamp)
@@ -21,57 +26,79 @@ def get_aws_v4_signature_key(key, datestamp, region, service):
     return sign(key_service, 'aws4_request')
 
 def get_aws_v4_cannonical_query_string(query_string):
-    # Get the query string from the starlette request object
-    # Split the query string into a list of key-value pairs
-    query_string_list = query_string.split('&')
-    # Sort the list of key-value pairs
-    query_string_list.sort()
-    # Join the list of key-value pairs into a string
-    query_string = '&'.join(query_string_list)
-    # Return the query string
-    return query_string
+    # each parameter is URI-encoded (the client may have encoded it differently), a
+    # parameter without a value gets an empty one ("?uploads" signs as "uploads="),
+    # then the parameters are sorted by name and value
+    parameters = []
+    for parameter in query_string.split('&'):
+        if not parameter:
+            continue
+        name, _, value = parameter.partition('=')
+        parameters.append((quote(unquote(name), safe='-_.~'), quote(unquote(value), safe='-_.~')))
+    parameters.sort()
+    return '&'.join(f'{name}={value}' for name, value in parameters)
 
-def get_aws_v4_canonical_request(request):
+def parse_aws_v4_authorization(authorization):
+    # parse the authorization header once
+    # AWS4-HMAC-SHA256 Credential=<key id>/<date>/<region>/<service>/aws4_request, SignedHeaders=<h1;h2>, Signature=<signature>
+    algorithm, _, fields = authorization.partition(" ")
+    if algorithm != "AWS4-HMAC-SHA256":
+        return None
+    values = {}
+    for field in fields.split(","):
+        name, _, value = field.strip().partition("=")
+        values[name] = value
+    credentials = values.get("Credential", "").split("/")
+    if len(credentials) != 5 or "SignedHeaders" not in values or "Signature" not in values:
+        return None
+    return {
+        "access_key_id": credentials[0],
+        "datestamp": credentials[1],
+        "region": credentials[2],
+        "service": credentials[3],
+        "signed_headers": values["SignedHeaders"].split(";"),
+        "signature": values["Signature"],
+    }
+
+
+def get_aws_v4_canonical_request(request, signed_headers=None):
     # Get the HTTP method, URI, and query string from the starlette request object
     http_method = request.method
     canonical_uri = request.url.path
     query_string = get_aws_v4_cannonical_query_string(request.url.query)
 
-    # Get the authorization header from the request
-    authorization_header = request.headers['Authorization']
-    # Extract the list of signed headers from the authorization header
-    signed_headers = authorization_header.split(",")[1].split("=")[1].split(";")
-
-    # Get the headers from the request
-    headers = {}
-    for key in request.headers:
-        # Convert the header key to lowercase and remove any underscores
-        key_low = key.lower().replace('_', '-')
-        # Only include the header if it is listed in the signed headers
+    if signed_headers is None:
+        # Extract the list of signed headers from the authorization header
+        signed_headers = parse_aws_v4_authorization(request.headers['Authorization'])["signed_headers"]
 
-        if key_low in signed_headers:
-            # Only include the header if it is listed in the signed headers
-            headers[key_low] = request.headers[key]
+    # Get the signed headers from the request, starlette headers are case insensitive
+    header_keys = sorted(key.lower().replace('_', '-') for key in signed_headers)
+    # Create a list of headers in key1;key2 format
+    canonical_headers = '\n'.join(f'{key}:{request.headers.get(key, "")}' for key in header_keys)
 
     # Get the payload from the request
     payload = request.headers['x-amz-content-sha256']
-    # Create a list of header keys in the request
-    header_keys = sorted(headers.keys())
-    # Create a list of header values in the request
-    header_values = [headers[key] for key in header_keys]
-    # Create a list of headers in key1;key2 format
-    canonical_headers = '\n'.join(f'{key}:{value}' for key, value in zip(header_keys, header_values))
     # Create the AWS Canonical Request string
     canonical_request = f'{http_method}\n{canonical_uri}\n{query_string}\n{canonical_headers}\n\n{";".join(header_keys)}\n{payload}'
 
     return canonical_request
 
-def get_aws_signature_arguments(request):
-    # get the AWS signature arguments from the request
-    authorization = request.headers['Authorization']
-    credentials = authorization.split(",")[0].split("=")[1]
-    amzdate = request.headers['x-amz-date']
-    return os.getenv("AWS_SECRET_ACCESS_KEY"), get_aws_v4_canonical_request(request), credentials.split("/")[1], credentials.split("/")[2], credentials.split("/")[3], amzdate
+def verify_aws_v4_signature(request, authorization, aws_secret_access_key):
+    # authorization is the parsed authorization header of the request
+    if 'x-amz-date' not in request.headers or 'x-amz-content-sha256' not in request.headers:
+        return False
+    canonical_request = get_aws_v4_canonical_request(request, authorization["signed_headers"])
+    signature = get_aws_v4_signature(
+        aws_secret_access_key,
+        canonical_request,
+        authorization["datestamp"],
+        authorization["region"],
+        authorization["service"],
+        request.headers['x-amz-date'],
+    )
+    # constant time comparison to not leak how much of the signature matched, of bytes since
+    # compare_digest refuses strings with non-ASCII characters
+    return hmac.compare_digest(signature.encode(), authorization["signature"].encode("utf-8", "surrogateescape"))
 
 def get_aws_v4_signature(aws_secret_access_key, canonical_request, date_stamp, aws_region, service, amzdate):
     algorithm = 'AWS4-HMAC-SHA256'
@@ -0,0 +1,303 @@
+"""
+This module contains the compression of the stored objects, enabled with S3_COMPRESSION:
+"gzip" (always available) or "zstd" (pip install zstandard). Annotations compress 5-10x.
+A stored object is either the raw bytes of the object or a header (magic, codec, size of
+the object) followed by the encoded bytes. An uncompressed object starting with the magic
+is stored behind an "identity" header, so uploaded bytes are never mistaken for a
+compressed object whatever S3_COMPRESSION was when they were written.
+The ETag and the size of an object are always those of its raw bytes. The encoded bytes
+are a complete gzip or zstd stream, they can be served as is with a Content-Encoding.
+"""
+
+import gzip
+import hashlib
+import io
+import os
+import struct
+
+# zstd compresses better and faster than gzip, it is used when it is installed and configured
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from utils.files import replaced_file
+
+from dotenv import load_dotenv
+load_dotenv()
+
+# magic, codec, size of the object
+object_header = struct.Struct(">4sBQ")
+object_magic = b"\x89S3Z"
+codec_ids = {"identity": 0, "gzip": 1, "zstd": 2}
+codec_names = {codec_id: codec for codec, codec_id in codec_ids.items()}
+# the codecs that actually compress, with the extension of the files they write
+codec_extensions = {"gzip": ".gz", "zstd": ".zst"}
+
+
+def check_compression(codec):
+    if codec != "none" and codec not in codec_extensions:
+        raise ValueError(f"Unknown compression {codec}, expected none, gzip or zstd")
+    if codec == "zstd" and zstandard is None:
+        raise ValueError("zstd compression needs the zstandard package (pip install zstandard)")
+    return codec
+
+
+compression = check_compression(os.getenv("S3_COMPRESSION", "none"))
+# defaults to the level of the codec (gzip 6, zstd 3)
+compression_level = os.getenv("S3_COMPRESSION_LEVEL")
+
+
+def encoder(codec, file, level=None):
+    # a stream compressing what is written to file, closing it ends the compressed
+    # stream and leaves file open
+    if codec == "gzip":
+        # no file name and no mtime in the header, the same bytes always compress the same
+        return gzip.GzipFile(filename="", mode="wb", fileobj=file, compresslevel=int(level or 6), mtime=0)
+    return zstandard.ZstdCompressor(level=int(level or 3)).stream_writer(file, closefd=False)
+
+
+def decoder(codec, file):
+    if codec == "gzip":
+        return gzip.GzipFile(mode="rb", fileobj=file)
+    return zstandard.ZstdDecompressor().stream_reader(file, closefd=False)
+
+
+class BoundedReader:
+    # reads at most length bytes of file from its current position, the encoded bytes
+    # of a packed object are followed by other records
+
+    def __init__(self, file, length):
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def skip(self, length):
+        length = min(length, self.remaining)
+        self.file.seek(length, os.SEEK_CUR)
+        self.remaining -= length
+
+
+class KeepingWriter:
+    # writes to file and keeps what it wrote in memory until keeping is stopped, the
+    # encoded bytes of a small object are cached with its raw bytes
+
+    def __init__(self, file):
+        self.file = file
+        self.kept = []
+
+    def write(self, data):
+        if self.kept is not None:
+            self.kept.append(bytes(data))
+        return self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+
+def read_object_header(file, length):
+    # returns the codec (None for a raw object), the size of the object and the size of
+    # the header, file is left at the start of the bytes of the object
+    data = file.read(min(object_header.size, length))
+    if len(data) == object_header.size and data.startswith(object_magic):
+        _, codec_id, size = object_header.unpack(data)
+        if codec_id not in codec_names:
+            raise ValueError(f"Unknown codec {codec_id} in the header of a stored object")
+        return codec_names[codec_id], size, object_header.size
+    file.seek(-len(data), os.SEEK_CUR)
+    return None, length, 0
+
+
+class ObjectWriter:
+    # writes an object to file, from its current position, in the stored format of codec
+    # finish() must be called once all the bytes of the object are written
+    # the raw bytes of an object of at most keep bytes are kept in memory (see utils/object_cache.py),
+    # with its encoded bytes if it is compressed
+
+    def __init__(self, file, codec=None, keep=0):
+        self.file = file
+        self.start = file.tell()
+        self.size = 0
+        self.keep = keep
+        self.kept = [] if keep > 0 else None
+        self.stream = None
+        self.keeping = None
+        self.header = False
+        # the first bytes of an uncompressed object, until they tell whether it needs a header
+        self.head = b""
+        self.codec = compression if codec is None else codec
+        if self.codec != "none":
+            self.begin(self.codec)
+
+    def begin(self, codec):
+        # the size in the header is written by finish()
+        self.codec = codec
+        self.header = True
+        self.file.write(object_header.pack(object_magic, codec_ids[codec], 0))
+        if codec == "identity":
+            self.stream = self.file
+            return
+        if self.kept is not None:
+            self.keeping = KeepingWriter(self.file)
+        self.stream = encoder(codec, self.file if self.keeping is None else self.keeping, compression_level)
+
+    @property
+    def data(self):
+        # the raw bytes of the object, None if they were not kept
+        return None if self.kept is None else b"".join(self.kept)
+
+    @property
+    def encoding(self):
+        # the codec of the encoded bytes, None if the object is not compressed
+        return self.codec if self.codec in codec_extensions else None
+
+    @property
+    def encoded(self):
+        # the encoded bytes of the object, None if they were not kept or it is not compressed
+        if self.keeping is None or self.keeping.kept is None:
+            return None
+        return b"".join(self.keeping.kept)
+
+    def write(self, data):
+        self.size += len(data)
+        if self.kept is not None:
+            if self.size <= self.keep:
+                self.kept.append(data)
+            else:
+                self.kept = None
+                if self.keeping is not None:
+                    self.keeping.kept = None
+        if self.stream is None:
+            self.head += data
+            if len(self.head) < len(object_magic):
+                return
+            data, self.head = self.head, b""
+            if data.startswith(object_magic):
+                self.begin("identity")
+            else:
+                self.stream = self.file
+        self.stream.write(data)
+
+    def finish(self):
+        # returns the stored length of the object
+        if self.stream is None:
+            # shorter than the magic
+            self.file.write(self.head)
+        elif self.stream is not self.file:
+            self.stream.close()
+        end = self.file.tell()
+        if self.header:
+            self.file.seek(self.start)
+            self.file.write(object_header.pack(object_magic, codec_ids[self.codec], self.size))
+            self.file.seek(end)
+        return end - self.start
+
+
+class ObjectReader:
+    # reads an object stored at the current position of file, length is its stored length
+    # with decode False, the bytes of a compressed object are read as they are stored
+
+    def __init__(self, file, length, decode=True):
+        self.file = file
+        self.codec, self.size, header_size = read_object_header(file, length)
+        self.source = BoundedReader(file, length - header_size)
+        self.stream = self.source
+        self.encoding = None
+        if self.codec in codec_extensions:
+            if decode:
+                self.stream = decoder(self.codec, self.source)
+            else:
+                self.encoding = self.codec
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+    def read_all(self, chunk_size=1024 * 1024):
+        return b"".join(iter(lambda: self.stream.read(chunk_size), b""))
+
+    def skip(self, length, chunk_size=1024 * 1024):
+        if self.stream is self.source:
+            self.source.skip(length)
+            return
+        # the decoded bytes can only be skipped by decoding them
+        while length > 0:
+            chunk = self.stream.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_object(file_path, offset=0, length=None, decode=True):
+    # the object stored in file_path at offset, the whole file by default
+    file = open(file_path, "rb")
+    try:
+        if length is None:
+            length = os.fstat(file.fileno()).st_size - offset
+        file.seek(offset)
+        return ObjectReader(file, length, decode)
+    except BaseException:
+        file.close()
+        raise
+
+
+def object_encoding(file_path, offset, length):
+    # the codec of the encoded bytes of a stored object, None if it is not compressed
+    with open_object(file_path, offset, length, decode=False) as reader:
+        return reader.encoding
+
+
+def read_object(file_path, offset=0, length=None):
+    # the raw bytes of the object stored in file_path at offset, the whole file by default
+    with open_object(file_path, offset, length) as reader:
+        return reader.read_all()
+
+
+def read_stored_object(file_path, offset=0, length=None):
+    # the raw bytes of the object stored in file_path at offset with its encoded bytes and
+    # their codec, None and None if it is not compressed, the file is only read once
+    with open_object(file_path, offset, length, decode=False) as reader:
+        encoded = reader.read_all()
+        if reader.encoding is None:
+            return encoded, None, None
+    stream = decoder(reader.encoding, io.BytesIO(encoded))
+    data = b"".join(iter(lambda: stream.read(1024 * 1024), b""))
+    return data, encoded, reader.encoding
+
+
+def decode_object(data):
+    # the raw bytes of a stored object read into memory
+    return ObjectReader(io.BytesIO(data), len(data)).read_all()
+
+
+def object_digest(file_path, chunk_size=1024 * 1024):
+    # the hex MD5 (the S3 ETag) and the size of the object stored in file_path
+    md5_hash = hashlib.md5()
+    size = 0
+    with open_object(file_path) as reader:
+        for chunk in iter(lambda: reader.read(chunk_size), b""):
+            md5_hash.update(chunk)
+            size += len(chunk)
+    return md5_hash.hexdigest(), size
+
+
+def compress_file(source_path, target_path, codec, chunk_size=1024 * 1024):
+    # a plain gzip or zstd file, the same source always gives the same bytes
+    with open(source_path, "rb") as r_stream, replaced_file(target_path) as w_stream:
+        with encoder(codec, w_stream, compression_level) as stream:
+            for chunk in iter(lambda: r_stream.read(chunk_size), b""):
+                stream.write(chunk)
@@ -1,71 +1,505 @@
+import hashlib
 import json
 import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
 from subprocess import run, PIPE, STDOUT 
 
+from utils.compression import check_compression, codec_extensions, compress_file
+from utils.files import copy_exact, replaced_file, save_json
+from utils.key_index import is_upload_temp_file
+from utils.metadata import get_object_etag
+from utils.packed_store import packed_store
+from utils.timing import timed_stage
+from utils.transform import json_codec, transform_annotation_file, transform_stored_annotation
+
 from dotenv import load_dotenv
 load_dotenv()
 
-def transform_label_studio_annotation_to_task(annotation):
-    label_studio_task = annotation["task"]
-    del annotation["task"]
-    label_studio_task["annotations"] = []
-    label_studio_task["annotations"].append(annotation)
-    return label_studio_task
+# number of worker processes transforming the annotations and the minimum number of
+# changed annotations for which starting them is worth it
+build_workers = int(os.getenv("DATASET_BUILD_WORKERS", str(os.cpu_count() or 1)))
+build_parallel_min = int(os.getenv("DATASET_BUILD_PARALLEL_MIN", "1000"))
 
 
-def dvc_update_dataset_file(s3_data_physical_path):
-    git_folder = os.getenv("GIT_FOLDER")
-    dataset = os.getenv("DVC_DATASET")
-    # create an empty dataset file
-    open(f"{git_folder}/{dataset}", "w").close()
+def dataset_format(config):
+    # "json" writes the dataset as one JSON array, "jsonl" as one JSONL file, "jsonl-shards"
+    # writes DVC_DATASET as a directory of DVC_DATASET_SHARDS JSONL files so dvc only pushes
+    # the changed shards
+    return config.get("DVC_DATASET_FORMAT", "json")
 
-    # open a write stream to the file
-    with open(f"{git_folder}/{dataset}", "w") as w_stream:
-        # write the opening "[" character to the write stream
-        w_stream.write("[")
 
-        # loop and read the contents of all files in s3_data_physical_path
-        for _, file in enumerate(os.listdir(s3_data_physical_path)):
-            file_path = f"{s3_data_physical_path}/{file}"
-            with open(file_path, "r") as f:
-                # read the file contents
-                file_content = f.read()
+# opening, separator and closing bytes of the single file formats
+dataset_file_formats = {"json": (b"[", b",", b"]"), "jsonl": (b"", b"\n", b"")}
 
-                # transform label studio annotation to an importable task
-                ls_task = transform_label_studio_annotation_to_task(json.loads(file_content))
 
-                # write the transformed data to the write stream
-                w_stream.write(json.dumps(ls_task))
+def dataset_compression(config):
+    # "gzip" or "zstd" compresses the dataset pushed by dvc, the dataset is built uncompressed
+    # in .dvc/tmp then compressed into DVC_DATASET (e.g. "data/data.jsonl.zst"), the shards
+    # are named part-NNNNN.jsonl.gz or part-NNNNN.jsonl.zst
+    return check_compression(config.get("DVC_DATASET_COMPRESSION", "none"))
 
-                # write a comma separator if not the last file
-                w_stream.write(",")
 
-        # delete the last comma separator
-        w_stream.seek(w_stream.tell() - 1, os.SEEK_SET)
-        # write the closing "]" character to the write stream
-        w_stream.write("]")
+def dataset_build_path(config):
+    git_folder = config.get("GIT_FOLDER")
+    if dataset_compression(config) == "none":
+        return f"{git_folder}/{config.get('DVC_DATASET')}"
+    return f"{git_folder}/.dvc/tmp/dataset_build"
 
 
+def dataset_index_path(config):
+    git_folder = config.get("GIT_FOLDER")
+    # the index lives in .dvc/tmp which is ignored by git and by dvc
+    return config.get("DVC_DATASET_INDEX", f"{git_folder}/.dvc/tmp/dataset_index.json")
 
-def dvc_commit_push():
-    git_folder = os.getenv("GIT_FOLDER")
-    dataset = os.getenv("DVC_DATASET")
-    # commit the changes to dvc repo
-    run(
-        ["dvc", "commit", f"{dataset}.dvc", "-f"],
-        cwd=git_folder,
-        stdout=PIPE
+
+def load_dataset_index(config):
+    try:
+        with open(dataset_index_path(config), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_dataset_index(index, config):
+    index_path = dataset_index_path(config)
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    save_json(index_path, index)
+
+
+def synced_digest_path(config):
+    git_folder = config.get("GIT_FOLDER")
+    return f"{git_folder}/.dvc/tmp/synced_digest"
+
+
+def dataset_digest(s3_data_physical_path, config=os.environ):
+    # digest of the (key, ETag) pairs of the annotations, the ETags come from the
+    # metadata cache so no annotation is read unless it changed
+    # the dataset settings are part of it, changing one rebuilds and pushes the dataset
+    digest = hashlib.sha256(s3_data_physical_path.encode("utf-8"))
+    settings = (
+        config.get("DVC_DATASET"), dataset_format(config), dataset_compression(config),
+        config.get("DVC_DATASET_SHARDS", "64"),
     )
+    digest.update(json.dumps(settings).encode("utf-8"))
+    if packed_store is not None:
+        # the packed store knows the ETags
+        for name, record in sorted(packed_store.scan(s3_data_physical_path).items()):
+            digest.update(f"\0{name}\0{record.e_tag}".encode("utf-8"))
+        return digest.hexdigest()
 
-    # push the changes to dvc remote
-    out = run(
-        ["dvc", "push"],
-        cwd=git_folder,
-        stdout=PIPE,
-        stderr=STDOUT
+    with os.scandir(s3_data_physical_path) as it:
+        entries = sorted(
+            (entry for entry in it if entry.is_file() and not is_upload_temp_file(entry.name)),
+            key=lambda entry: entry.name,
+        )
+    for entry in entries:
+        e_tag = get_object_etag(entry.path, entry.stat())
+        digest.update(f"\0{entry.name}\0{e_tag}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def dataset_is_synced(digest, config=os.environ):
+    # True if the last successful sync had the same annotations
+    git_folder = config.get("GIT_FOLDER")
+    dataset = config.get("DVC_DATASET")
+    if not os.path.exists(f"{git_folder}/{dataset}"):
+        return False
+    try:
+        with open(synced_digest_path(config), "r") as f:
+            return f.read() == digest
+    except OSError:
+        return False
+
+
+def save_synced_digest(digest, config=os.environ):
+    os.makedirs(os.path.dirname(synced_digest_path(config)), exist_ok=True)
+    with open(synced_digest_path(config), "w") as f:
+        f.write(digest)
+
+
+def dataset_sort_key(file):
+    # label studio annotation ids are increasing integers, sorting them numerically
+    # makes new annotations land at the end of the dataset file
+    if file.isdigit():
+        return (0, int(file), file)
+    return (1, 0, file)
+
+
+def transform_annotations(s3_data_physical_path, keys):
+    # key -> (task id, serialized task), large batches are read, parsed and transformed
+    # by a pool of worker processes, map keeps the results in the order of keys
+    if packed_store is not None:
+        # the annotations are read sequentially from the segments, the workers get their content
+        records = packed_store.scan(s3_data_physical_path)
+        data = packed_store.read_objects({key: records[key] for key in keys})
+        transform, arguments = transform_stored_annotation, [data[key] for key in keys]
+    else:
+        transform, arguments = transform_annotation_file, [f"{s3_data_physical_path}/{key}" for key in keys]
+    if build_workers <= 1 or len(arguments) < build_parallel_min:
+        return dict(zip(keys, map(transform, arguments)))
+
+    # spawn, forking a process running threads (uvicorn, sync worker) is not safe
+    with ProcessPoolExecutor(build_workers, mp_context=get_context("spawn")) as executor:
+        chunksize = max(1, len(arguments) // (build_workers * 8))
+        return dict(zip(keys, executor.map(transform, arguments, chunksize=chunksize)))
+
+
+def write_dataset_entries(w_stream, r_stream, keys, old_entries, transformed, stats, separator, needs_separator):
+    # write the entries of keys to w_stream and return their new index entries
+    # [mtime_ns, size, offset, length], changed entries are taken from transformed,
+    # unchanged entries are copied as raw bytes from r_stream, runs of entries that
+    # were contiguous in the old file are copied at once
+    entries = {}
+    run_keys = []
+    run_old_start = run_old_end = run_new_start = 0
+
+    def flush_run():
+        if run_keys:
+            r_stream.seek(run_old_start)
+            copy_exact(r_stream, w_stream, run_old_end - run_old_start)
+            for run_key in run_keys:
+                old_offset, old_length = old_entries[run_key][2:4]
+                entries[run_key] = [*stats[run_key], run_new_start + old_offset - run_old_start, old_length]
+            run_keys.clear()
+
+    for key in keys:
+        if key in transformed:
+            flush_run()
+            if needs_separator:
+                w_stream.write(separator)
+            _, data = transformed[key]
+            entries[key] = [*stats[key], w_stream.tell(), len(data)]
+            w_stream.write(data)
+        else:
+            old_offset, old_length = old_entries[key][2:4]
+            # the separator between two contiguous entries is copied with the run
+            if run_keys and old_offset == run_old_end + len(separator):
+                run_old_end = old_offset + old_length
+            else:
+                flush_run()
+                if needs_separator:
+                    w_stream.write(separator)
+                run_old_start, run_old_end, run_new_start = old_offset, old_offset + old_length, w_stream.tell()
+            run_keys.append(key)
+        needs_separator = True
+
+    flush_run()
+    return entries
+
+
+def scan_annotations(s3_data_physical_path):
+    # key -> [mtime_ns, size] of all the annotations
+    if packed_store is not None:
+        return {
+            name: [record.mtime_ns, record.length] for name, record in packed_store.scan(s3_data_physical_path).items()
+        }
+    stats = {}
+    with os.scandir(s3_data_physical_path) as it:
+        for entry in it:
+            if entry.is_file() and not is_upload_temp_file(entry.name):
+                stat = entry.stat()
+                stats[entry.name] = [stat.st_mtime_ns, stat.st_size]
+    return stats
+
+
+def shard_file_name(shard):
+    return f"part-{shard:05d}.jsonl"
+
+
+def task_shard(task_id, shard_count):
+    # stable across processes and python versions, unlike hash()
+    digest = hashlib.sha1(str(task_id).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % shard_count
+
+
+def dataset_index_matches(index, s3_data_physical_path, build_path, dataset_path, config):
+    # the index can only be trusted if the dataset is exactly the one the index describes
+    compression = dataset_compression(config)
+    if (
+        index is None
+        or index.get("source") != s3_data_physical_path
+        or index.get("format") != dataset_format(config)
+        or index.get("codec") != json_codec
+        or index.get("compression", "none") != compression
+    ):
+        return False
+    if dataset_format(config) == "jsonl-shards":
+        if index.get("shards") != int(config.get("DVC_DATASET_SHARDS", "64")):
+            return False
+        for shard, size in index["sizes"].items():
+            shard_path = f"{build_path}/{shard_file_name(int(shard))}"
+            if not os.path.exists(shard_path) or os.path.getsize(shard_path) != size:
+                return False
+            if compression != "none":
+                if not os.path.exists(f"{dataset_path}/{shard_file_name(int(shard))}{codec_extensions[compression]}"):
+                    return False
+        return True
+    if not os.path.exists(dataset_path):
+        return False
+    return os.path.exists(build_path) and os.path.getsize(build_path) == index.get("size")
+
+
+def export_compressed_dataset(build_path, dataset_path, config):
+    # compress the dataset built in .dvc/tmp into DVC_DATASET, a shard is only compressed
+    # again if it was rewritten since, gzip and zstd give the same bytes for the same shard
+    # so dvc does not push the unchanged ones
+    compression = dataset_compression(config)
+    if dataset_format(config) != "jsonl-shards":
+        os.makedirs(os.path.dirname(dataset_path), exist_ok=True)
+        compress_file(build_path, dataset_path, compression)
+        return 1
+
+    os.makedirs(dataset_path, exist_ok=True)
+    extension = codec_extensions[compression]
+    shards = {file for file in os.listdir(build_path) if file.startswith("part-") and file.endswith(".jsonl")}
+    for file in os.listdir(dataset_path):
+        # deleted shards and shards of another format or compression
+        if file.startswith("part-") and (not file.endswith(extension) or file[:-len(extension)] not in shards):
+            os.unlink(f"{dataset_path}/{file}")
+    compressed = 0
+    for file in sorted(shards):
+        shard_path = f"{build_path}/{file}"
+        target_path = f"{dataset_path}/{file}{extension}"
+        if not os.path.exists(target_path) or os.stat(target_path).st_mtime_ns < os.stat(shard_path).st_mtime_ns:
+            compress_file(shard_path, target_path, compression)
+            compressed += 1
+    return compressed
+
+
+def dvc_update_dataset_file(s3_data_physical_path, config=os.environ):
+    git_folder = config.get("GIT_FOLDER")
+    dataset = config.get("DVC_DATASET")
+    dataset_path = f"{git_folder}/{dataset}"
+    build_path = dataset_build_path(config)
+
+    # stat all the annotations, only the changed ones will be read and transformed
+    stats = scan_annotations(s3_data_physical_path)
+    keys = sorted(stats, key=dataset_sort_key)
+
+    # the index maps every annotation to its mtime, size and byte range in the dataset
+    index = load_dataset_index(config)
+    if not dataset_index_matches(index, s3_data_physical_path, build_path, dataset_path, config):
+        print("## Dataset | Full rebuild")
+        index = {"entries": {}, "sizes": {}}
+        # the build of another format or compression
+        if build_path != dataset_path and os.path.isdir(build_path):
+            shutil.rmtree(build_path)
+        elif build_path != dataset_path and os.path.exists(build_path):
+            os.unlink(build_path)
+    old_entries = index["entries"]
+
+    changed = [key for key in keys if old_entries.get(key, [None, None])[:2] != stats[key]]
+    deleted = old_entries.keys() - stats.keys()
+    if not changed and not deleted and old_entries:
+        print("## Dataset | Up to date")
+        return
+
+    transformed = transform_annotations(s3_data_physical_path, changed)
+
+    # the index no longer describes the dataset once we start writing to it
+    if os.path.exists(dataset_index_path(config)):
+        os.unlink(dataset_index_path(config))
+
+    if dataset_format(config) == "jsonl-shards":
+        new_index, rewritten = update_sharded_dataset(
+            build_path, keys, stats, old_entries, transformed, deleted, index["sizes"],
+            int(config.get("DVC_DATASET_SHARDS", "64")),
+        )
+    else:
+        new_index, rewritten = update_json_dataset(
+            build_path, keys, stats, old_entries, transformed, dataset_format(config)
+        )
+
+    if dataset_compression(config) != "none":
+        compressed = export_compressed_dataset(build_path, dataset_path, config)
+        print(f"## Dataset | {compressed} files compressed")
+
+    save_dataset_index(
+        {
+            "source": s3_data_physical_path, "format": dataset_format(config), "codec": json_codec,
+            "compression": dataset_compression(config), **new_index,
+        },
+        config,
     )
+    print(f"## Dataset | {len(changed)} changed, {len(deleted)} deleted, {rewritten} rewritten")
+
+
+def update_json_dataset(dataset_path, keys, stats, old_entries, transformed, file_format):
+    # one JSON array or JSONL file, the entries before the first difference stay in place
+    # and only the tail is rewritten
+    opening, separator, closing = dataset_file_formats[file_format]
+    old_keys = sorted(old_entries, key=lambda key: old_entries[key][2])
+    prefix_count = 0
+    for key, old_key in zip(keys, old_keys):
+        if key != old_key or key in transformed:
+            break
+        prefix_count += 1
+
+    entries = {key: old_entries[key] for key in keys[:prefix_count]}
+    if prefix_count > 0:
+        last_offset, last_length = old_entries[keys[prefix_count - 1]][2:4]
+        prefix_end = last_offset + last_length
+    else:
+        prefix_end = len(opening)
+
+    os.makedirs(os.path.dirname(dataset_path), exist_ok=True)
+    tail_path = f"{dataset_path}.tail"
+    # build the new tail in a temporary file, it may copy bytes from the current dataset file
+    with open(tail_path, "w+b") as tail_stream:
+        r_stream = open(dataset_path, "rb") if old_entries else None
+        try:
+            tail_entries = write_dataset_entries(
+                tail_stream, r_stream, keys[prefix_count:], old_entries, transformed, stats,
+                separator, prefix_count > 0
+            )
+        finally:
+            if r_stream is not None:
+                r_stream.close()
+        tail_stream.write(closing)
+
+        # splice the tail into the dataset file right after the unchanged prefix
+        with open(dataset_path, "r+b" if prefix_count > 0 else "wb") as w_stream:
+            if prefix_count > 0:
+                w_stream.seek(prefix_end)
+                w_stream.truncate()
+            else:
+                w_stream.write(opening)
+            tail_stream.seek(0)
+            shutil.copyfileobj(tail_stream, w_stream)
+            size = w_stream.tell()
+
+    os.unlink(tail_path)
+
+    # tail offsets are relative to the tail file, shift them to the dataset file
+    for key in keys[prefix_count:]:
+        mtime_ns, file_size, offset, length = tail_entries[key]
+        entries[key] = [mtime_ns, file_size, prefix_end + offset, length]
+
+    return {"size": size, "entries": entries}, len(keys) - prefix_count
+
+
+def update_sharded_dataset(dataset_path, keys, stats, old_entries, transformed, deleted, old_sizes, shard_count):
+    # a directory of JSONL shards, a task goes to the shard of its id so only the
+    # shards containing changed tasks are rewritten and pushed by dvc
+    shard_of = {key: old_entries[key][4] for key in keys if key not in transformed}
+    for key, (task_id, _) in transformed.items():
+        shard_of[key] = task_shard(key if task_id is None else task_id, shard_count)
+
+    dirty_shards = {shard_of[key] for key in transformed}
+    dirty_shards.update(old_entries[key][4] for key in transformed if key in old_entries)
+    dirty_shards.update(old_entries[key][4] for key in deleted)
+
+    os.makedirs(dataset_path, exist_ok=True)
+    if not old_entries:
+        # full rebuild, remove the shards of a previous build
+        for file in os.listdir(dataset_path):
+            if file.startswith("part-") and file.endswith(".jsonl"):
+                os.unlink(f"{dataset_path}/{file}")
+
+    shard_keys = {shard: [] for shard in dirty_shards}
+    for key in keys:
+        if shard_of[key] in shard_keys:
+            shard_keys[shard_of[key]].append(key)
+
+    entries = {key: old_entries[key] for key in keys if shard_of[key] not in dirty_shards}
+    sizes = {shard: size for shard, size in old_sizes.items() if int(shard) not in dirty_shards}
+    for shard in sorted(dirty_shards):
+        shard_path = f"{dataset_path}/{shard_file_name(shard)}"
+        if not shard_keys[shard]:
+            if os.path.exists(shard_path):
+                os.unlink(shard_path)
+            continue
+
+        # write the new shard next to the old one, it may copy lines from it
+        r_stream = open(shard_path, "rb") if str(shard) in old_sizes else None
+        try:
+            with replaced_file(shard_path) as w_stream:
+                shard_entries = write_dataset_entries(
+                    w_stream, r_stream, shard_keys[shard], old_entries, transformed, stats, b"\n", False
+                )
+                w_stream.write(b"\n")
+                sizes[str(shard)] = w_stream.tell()
+        finally:
+            if r_stream is not None:
+                r_stream.close()
+
+        for key, entry in shard_entries.items():
+            entries[key] = [*entry, shard]
+
+    return {"shards": shard_count, "sizes": sizes, "entries": entries}, sum(map(len, shard_keys.values()))
+
 
+# git folder -> dvc.repo.Repo, kept open across syncs
+dvc_repos = {}
+
+
+def get_dvc_repo(git_folder):
+    dvc_repo = dvc_repos.get(git_folder)
+    if dvc_repo is None:
+        # importing dvc takes seconds, it is only paid once per process
+        from dvc.repo import Repo
+        dvc_repo = dvc_repos[git_folder] = Repo(git_folder)
+    return dvc_repo
+
+
+def close_dvc_repo(git_folder):
+    # the .dvc files changed on disk (pull, clone), the next sync reopens the repo
+    dvc_repo = dvc_repos.pop(git_folder, None)
+    if dvc_repo is not None:
+        dvc_repo.close()
+
+
+def dvc_commit_push(config=os.environ):
+    # commit the dataset and push it to the dvc remote
+    # returns True if something was pushed
+    # DVC_BACKEND "api" runs dvc in-process through its Python API, "cli" runs the dvc command
+    if config.get("DVC_BACKEND", "api") == "cli":
+        return dvc_commit_push_cli(config)
+
+    git_folder = config.get("GIT_FOLDER")
+    dataset = config.get("DVC_DATASET")
+    dvc_repo = get_dvc_repo(git_folder)
+
+    # commit the changes to dvc repo
+    with timed_stage("dvc_commit"):
+        dvc_repo.commit(f"{git_folder}/{dataset}.dvc", force=True)
+
+    # push the changes to dvc remote
+    with timed_stage("dvc_push"):
+        pushed = dvc_repo.push()
+
+    print(f"## DvC | {pushed} files pushed")
+    return pushed > 0
+
+
+def dvc_commit_push_cli(config):
+    git_folder = config.get("GIT_FOLDER")
+    dataset = config.get("DVC_DATASET")
+    # commit the changes to dvc repo
+    with timed_stage("dvc_commit"):
+        out = run(
+            ["dvc", "commit", f"{dataset}.dvc", "-f"],
+            cwd=git_folder,
+            stdout=PIPE,
+            stderr=STDOUT
+        )
     if out.returncode != 0:
-        print("## Sync failed | ", out.stdout.decode())
-   
-    return out.stdout.decode()
+        raise RuntimeError(f"dvc commit failed: {out.stdout.decode()}")
+
+    # push the changes to dvc remote
+    with timed_stage("dvc_push"):
+        out = run(
+            ["dvc", "push"],
+            cwd=git_folder,
+            stdout=PIPE,
+            stderr=STDOUT
+        )
+
+    # the .dvc file must not be pushed to git if its data is not on the dvc remote
+    if out.returncode != 0:
+        raise RuntimeError(f"dvc push failed: {out.stdout.decode()}")
+
+    # check if the output contains "Everything is up to date."
+    return not "Everything is up to date." in out.stdout.decode()
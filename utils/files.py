@@ -0,0 +1,52 @@
+"""
+This module contains the file helpers shared by the storage modules. A file that must
+never be seen half written (the metadata cache, the indexes, the dataset) is written to a
+temporary file next to it, then renamed over it so a crash never leaves a truncated file.
+The incremental dataset build and the packed store compaction copy byte ranges between files.
+The other storage folders and files default to siblings of S3_DATA_FOLDER.
+"""
+
+import json
+import os
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+load_dotenv()
+
+data_folder = os.getenv("S3_DATA_FOLDER")
+
+
+def storage_path(name):
+    # e.g. "./storage/s3/packed" for the S3_DATA_FOLDER "./storage/s3/objects"
+    return os.path.join(os.path.dirname(str(data_folder).rstrip("/")), name)
+
+
+
+@contextmanager
+def replaced_file(path, mode="wb"):
+    # yields a temporary file next to path, renamed to path once it is written, the
+    # temporary file is removed if writing it fails
+    temp_path = f"{path}.tmp"
+    try:
+        with open(temp_path, mode) as file:
+            yield file
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+
+def copy_exact(r_stream, w_stream, length, chunk_size=1024 * 1024):
+    # copy length bytes from the current position of r_stream
+    while length > 0:
+        chunk = r_stream.read(min(chunk_size, length))
+        if not chunk:
+            raise EOFError(f"unexpected end of file while copying {length} bytes")
+        w_stream.write(chunk)
+        length -= len(chunk)
+
+
+def save_json(path, data):
+    with replaced_file(path, "w") as f:
+        json.dump(data, f)
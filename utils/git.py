@@ -1,4 +1,6 @@
 import os
+import random
+import time
 import git
 import shutil
 
@@ -7,57 +9,153 @@ from subprocess import run, PIPE
 from dotenv import load_dotenv
 load_dotenv()
 
+# a push rejected because the remote branch moved (or failing) is retried GIT_PUSH_RETRIES
+# times, after GIT_PUSH_BACKOFF_SECONDS, doubled at every attempt
+push_retries = int(os.getenv("GIT_PUSH_RETRIES", "5"))
+push_backoff_seconds = float(os.getenv("GIT_PUSH_BACKOFF_SECONDS", "1"))
 
-def git_pull():
-    git_folder = os.getenv("GIT_FOLDER")
-    branch = os.getenv("GIT_BRANCH")
 
-    # take the repo
-    repo = git.Repo(git_folder)
+# git folder -> git.Repo, kept open across syncs so GitPython can reuse its
+# persistent git cat-file processes instead of starting new ones
+repos = {}
+
+
+def get_repo(git_folder):
+    repo = repos.get(git_folder)
+    if repo is None:
+        repo = repos[git_folder] = git.Repo(git_folder)
+    return repo
+
+
+def close_repo(git_folder):
+    repo = repos.pop(git_folder, None)
+    if repo is not None:
+        repo.close()
+
+
+def remote_branch_head(repo, branch):
+    # the commit of the branch on the remote, one round trip that downloads no object
+    output = repo.git.ls_remote("origin", f"refs/heads/{branch}")
+    return output.split()[0] if output else None
+
+
+def tracking_branch_head(repo, branch):
+    try:
+        return repo.commit(f"origin/{branch}").hexsha
+    except (git.BadName, ValueError):
+        return None
+
+
+def git_fetch_rebase(repo, branch):
+    # fetch the branch and replay the commits not pushed yet (the .dvc file commits of the
+    # syncs) on top of it, the .dvc file of the sync wins a conflict since it describes the
+    # dataset that was built and pushed to dvc
+    repo.git.fetch("origin", f"+refs/heads/{branch}:refs/remotes/origin/{branch}")
+    try:
+        # the dvc remote configuration is a local change of .dvc/config
+        repo.git.rebase("--autostash", "-X", "theirs", f"origin/{branch}")
+    except git.GitCommandError as e:
+        try:
+            repo.git.rebase("--abort")
+        except git.GitCommandError:
+            pass
+        raise RuntimeError(f"The commits of the sync can not be rebased on origin/{branch}: {e}")
 
-    # pull the repo
-    origin = repo.remote(name="origin")
-    origin.pull(branch)
 
+def git_pull(config=os.environ):
+    git_folder = config.get("GIT_FOLDER")
+    branch = config.get("GIT_BRANCH")
 
-def git_commit_push():
-    git_folder = os.getenv("GIT_FOLDER")
-    dataset = os.getenv("DVC_DATASET")
-    branch = os.getenv("GIT_BRANCH")
+    # take the repo
+    repo = get_repo(git_folder)
+    head = repo.head.commit.hexsha
+
+    # nothing to fetch if the remote branch did not move since the last fetch
+    tracking_head = tracking_branch_head(repo, branch)
+    if (
+        tracking_head is not None
+        and remote_branch_head(repo, branch) == tracking_head
+        and repo.is_ancestor(tracking_head, head)
+    ):
+        return False
+
+    git_fetch_rebase(repo, branch)
+
+    # tell the caller if the pull brought new commits
+    return repo.head.commit.hexsha != head
+
+
+def git_push(repo, branch):
+    # push all the commits not pushed yet, the commits of the syncs that could not push
+    # (e.g. during an outage) go out together with the last one
+    # a rejected push (someone pushed in between) is rebased and retried with a backoff
+    for attempt in range(push_retries + 1):
+        try:
+            if attempt > 0:
+                git_fetch_rebase(repo, branch)
+            repo.git.push("origin", f"{branch}:refs/heads/{branch}")
+            return
+        except git.GitCommandError as e:
+            if attempt == push_retries:
+                raise
+            delay = push_backoff_seconds * 2 ** attempt * random.uniform(0.5, 1)
+            print(f"## GIT | Push failed, retrying in {delay:.1f}s | {str(e.stderr).strip()}")
+            time.sleep(delay)
+
+
+def git_commit_push(config=os.environ):
+    git_folder = config.get("GIT_FOLDER")
+    dataset = config.get("DVC_DATASET")
+    branch = config.get("GIT_BRANCH")
 
     # WARNING: only the .dvc will change in the git repo
     # it is very important to commit only the .dvc file otherwise all the 
     # other files from the repo will be deleted by the push
     
     # take the repo
-    repo = git.Repo(git_folder)
+    repo = get_repo(git_folder)
 
+    # the .dvc file only changes if the dataset changed
+    if repo.git.status("--porcelain", "--", f"{dataset}.dvc"):
+        # add the file to the git index
+        repo.git.add(f"{dataset}.dvc")
 
-    # add the file to the git index
-    repo.git.add(f"{dataset}.dvc")
+        # create a commit for a specific SINGLE file
+        repo.git.commit(f"{dataset}.dvc", m=f"update {dataset}.dvc")
 
-    # create a commit for a specific SINGLE file
-    repo.git.commit(f"{dataset}.dvc", m=f"update {dataset}.dvc") 
+    # returns True if commits were pushed
+    if not int(repo.git.rev_list("--count", f"origin/{branch}..HEAD")):
+        return False
 
-    # push the single file commit to the remote
-    origin = repo.remote(name="origin")
-    origin.push(branch)
+    # push the single file commits to the remote
+    git_push(repo, branch)
+    return True
 
     # delete the dataset file
     # if os.path.exists(f"{git_folder}/{dataset}"):
        # os.unlink(f"{git_folder}/{dataset}")
 
-def init_git_repo():
+def sparse_checkout_patterns(config):
+    # only the meta files the sync needs are checked out
+    dataset = config.get("DVC_DATASET")
+    return ["/.dvc/", "/.dvcignore", f"/{dataset}.dvc"]
 
 
-    print("## INIT | Project GIT")
-    # clone the git repo
-    git_folder = os.getenv("GIT_FOLDER")
-    git_repo = os.getenv("GIT_REPO")
-    git_branch = os.getenv("GIT_BRANCH")
-    dataset = os.getenv("DVC_DATASET")
-    git_pat_name = os.getenv("GIT_PAT_NAME")
+def git_clone_is_valid(git_folder, git_repo):
+    # an existing clone can be reused if it is a clone of the same repository
+    try:
+        repo = git.Repo(git_folder)
+    except (git.exc.InvalidGitRepositoryError, git.exc.NoSuchPathError):
+        return False
+    try:
+        return not repo.bare and repo.remote(name="origin").url == git_repo
+    except ValueError:
+        return False
+    finally:
+        repo.close()
 
+
+def clean_git_folder(git_folder):
     # delete the git folder if it exists
     if os.path.exists(git_folder):
         os.chmod(git_folder, 0o777)
@@ -69,35 +167,79 @@ def init_git_repo():
                 os.chmod(os.path.join(root, f), 0o777)
         shutil.rmtree(git_folder)
 
-    print("## INIT | Clean GIT folder")
 
-    git.Repo.clone_from(git_repo, git_folder, no_checkout=True)
+def init_git_repo(config=os.environ):
 
-    print("## INIT | Clone GIT repo")
 
-    # checkout the branch
-    repo = git.Repo(git_folder)
-        
+    print("## INIT | Project GIT")
+    # clone the git repo
+    git_folder = config.get("GIT_FOLDER")
+    git_repo = config.get("GIT_REPO")
+    git_branch = config.get("GIT_BRANCH")
+    git_pat_name = config.get("GIT_PAT_NAME")
+
+    close_repo(git_folder)
+
+    if git_clone_is_valid(git_folder, git_repo):
+        # warm start, only fetch the new commits of the branch
+        repo = get_repo(git_folder)
+        # a rebase interrupted by a crash would leave the clone without a branch
+        if any(os.path.isdir(os.path.join(repo.git_dir, name)) for name in ("rebase-merge", "rebase-apply")):
+            repo.git.rebase("--abort")
+        # drop the local changes (dvc config, uncommitted .dvc file), they are recreated below
+        # and by the next sync, but keep the commits that were not pushed yet
+        repo.git.reset("--hard", "HEAD")
+        if repo.head.is_detached or repo.active_branch.name != git_branch:
+            repo.git.fetch("origin", f"+refs/heads/{git_branch}:refs/remotes/origin/{git_branch}")
+            repo.git.checkout(git_branch)
+        # the commits not pushed yet are replayed on the new commits of the branch like a
+        # sync does, a merge would stop on a conflicting .dvc file
+        git_fetch_rebase(repo, git_branch)
+
+        print("## INIT | Reuse GIT clone")
+    else:
+        clean_git_folder(git_folder)
+
+        print("## INIT | Clean GIT folder")
+
+        # shallow, blob-less and sparse: only the last commit of the branch is fetched
+        # and only the blobs of the sparse checkout are downloaded
+        git.Repo.clone_from(
+            git_repo, git_folder,
+            branch=git_branch, depth=1, filter="blob:none", sparse=True, no_checkout=True,
+        )
+
+        print("## INIT | Clone GIT repo")
+
+        repo = get_repo(git_folder)
+
     repo.git.config("user.name", git_pat_name)
     repo.git.config("user.email", f"{ git_pat_name }@mlops.com")
 
     print("## INIT | GIT config")
 
-    repo.git.checkout(git_branch, ".dvc")
-    repo.git.checkout(git_branch, f"{dataset}.dvc")
+    # checkout the dvc meta files only, read-tree respects the sparse checkout patterns
+    repo.git.sparse_checkout("set", "--no-cone", *sparse_checkout_patterns(config))
+    repo.git.read_tree("-mu", "HEAD")
 
     print("## INIT | DvC")
     
     # setup DvC
 
-    dvc_remote_name = os.getenv("DVC_REMOTE_NAME")
-    dvc_cloud_storage_provider = os.getenv("DVC_CLOUD_STORAGE_PROVIDER")
-    dvc_bucket_name = os.getenv("DVC_BUCKET_NAME")
+    dvc_remote_name = config.get("DVC_REMOTE_NAME")
+    dvc_cloud_storage_provider = config.get("DVC_CLOUD_STORAGE_PROVIDER")
+    dvc_bucket_name = config.get("DVC_BUCKET_NAME")
 
     print("## INIT | DvC Add Remote")
 
+    if dvc_cloud_storage_provider == "local":
+        # a local directory as remote, used for development and by the benchmarks
+        dvc_remote_url = f"{os.path.abspath(dvc_bucket_name)}/dvcstore"
+    else:
+        dvc_remote_url = f"{dvc_cloud_storage_provider}://{dvc_bucket_name}/dvcstore"
+
     run(
-        f"dvc remote add -d {dvc_remote_name} {dvc_cloud_storage_provider}://{dvc_bucket_name}/dvcstore -f", 
+        f"dvc remote add -d {dvc_remote_name} {dvc_remote_url} -f", 
         cwd=git_folder, 
         stdout=PIPE,
         shell=True
@@ -106,8 +248,8 @@ def init_git_repo():
     if dvc_cloud_storage_provider == "gs":
         print("## INIT | DvC Add Remote | GS")
         # setup DvC to use GCP as remote storage
-        google_application_credentials = os.getenv("DVC_GOOGLE_APPLICATION_CREDENTIALS")
-        gcp_service_account_key = os.getenv("DVC_GCP_SERVICE_ACCOUNT_KEY")
+        google_application_credentials = config.get("DVC_GOOGLE_APPLICATION_CREDENTIALS")
+        gcp_service_account_key = config.get("DVC_GCP_SERVICE_ACCOUNT_KEY")
 
         with open(f"{git_folder}/{google_application_credentials}", "w") as f:
             f.write(gcp_service_account_key)
@@ -123,10 +265,10 @@ def init_git_repo():
     if dvc_cloud_storage_provider == "s3":
         print("## INIT | DvC Add Remote | S3")
         # setup DvC to use S3 as remote storage
-        dvc_s3_endpoint = os.getenv("DVC_S3_ENDPOINT")
+        dvc_s3_endpoint = config.get("DVC_S3_ENDPOINT")
 
-        dvc_s3_access_key_id = os.getenv("DVC_S3_ACCESS_KEY_ID")
-        dvc_s3_secret_access_key = os.getenv("DVC_S3_SECRET_ACCESS_KEY")
+        dvc_s3_access_key_id = config.get("DVC_S3_ACCESS_KEY_ID")
+        dvc_s3_secret_access_key = config.get("DVC_S3_SECRET_ACCESS_KEY")
 
         run(
             f"dvc remote modify {dvc_remote_name} endpointurl {dvc_s3_endpoint}",
@@ -0,0 +1,48 @@
+"""
+This module runs the blocking filesystem work of the S3 requests in worker threads, off
+the event loop. Every kind of operation has its own concurrency limit, so a burst of
+large listings or uploads can not take all the threads and stall the other requests:
+- read: GetObject (stat, ETag, file chunks), IO_READ_CONCURRENCY
+- write: PutObject and the multipart uploads, IO_WRITE_CONCURRENCY
+- list: ListObjects (key index scan, stat and ETag of every key), IO_LIST_CONCURRENCY
+"""
+
+import functools
+import os
+
+import anyio
+import anyio.to_thread
+
+from dotenv import load_dotenv
+load_dotenv()
+
+io_concurrency = {
+    "read": int(os.getenv("IO_READ_CONCURRENCY", "16")),
+    "write": int(os.getenv("IO_WRITE_CONCURRENCY", "8")),
+    "list": int(os.getenv("IO_LIST_CONCURRENCY", "4")),
+}
+
+# operation -> limiter, created on first use in the event loop
+limiters = {}
+
+
+def get_limiter(operation):
+    limiter = limiters.get(operation)
+    if limiter is None:
+        limiter = limiters[operation] = anyio.CapacityLimiter(io_concurrency[operation])
+    return limiter
+
+
+async def run_io(operation, func, *args, **kwargs):
+    # run func in a worker thread once a slot of the operation is free
+    return await anyio.to_thread.run_sync(functools.partial(func, *args, **kwargs), limiter=get_limiter(operation))
+
+
+async def iterate_io(operation, iterator):
+    # iterate a blocking iterator (e.g. a listing generator) in the worker threads of the operation
+    # the iterator must not yield None
+    while True:
+        item = await run_io(operation, next, iterator, None)
+        if item is None:
+            return
+        yield item
@@ -0,0 +1,109 @@
+"""
+This module contains an ordered index of the keys stored in each bucket.
+It is built lazily by walking the bucket folder (or from the index of the packed store)
+the first time a bucket is used and
+kept up to date by the write operations, so a listing page costs a binary search
+plus the size of the page instead of a walk of the whole bucket.
+"""
+
+import os
+import sys
+import threading
+from bisect import bisect_left, bisect_right
+
+from utils.files import data_folder
+from utils.packed_store import packed_store
+
+# prefix of the temporary files uploads are streamed to, they are not keys
+upload_temp_prefix = ".upload-"
+
+# sorts after every character, "prefix + max_char" sorts after every key starting with prefix
+max_char = chr(sys.maxunicode)
+
+# bucket -> sorted list of keys
+bucket_keys = {}
+index_lock = threading.Lock()
+
+
+def is_upload_temp_file(name):
+    return name.startswith(upload_temp_prefix)
+
+
+def scan_bucket_keys(bucket):
+    if packed_store is not None:
+        return packed_store.keys(bucket)
+    root = f"{data_folder}/{bucket}"
+    keys = []
+    for directory, _, files in os.walk(root):
+        relative = os.path.relpath(directory, root).replace(os.sep, "/")
+        for file in files:
+            if is_upload_temp_file(file):
+                continue
+            keys.append(file if relative == "." else f"{relative}/{file}")
+    keys.sort()
+    return keys
+
+
+def get_bucket_keys(bucket):
+    # must be called with index_lock held
+    keys = bucket_keys.get(bucket)
+    if keys is None:
+        keys = bucket_keys[bucket] = scan_bucket_keys(bucket)
+    return keys
+
+
+def add_key(bucket, key):
+    with index_lock:
+        keys = get_bucket_keys(bucket)
+        i = bisect_left(keys, key)
+        if i == len(keys) or keys[i] != key:
+            keys.insert(i, key)
+
+
+def remove_key(bucket, key):
+    with index_lock:
+        keys = get_bucket_keys(bucket)
+        i = bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            del keys[i]
+
+
+def list_keys(bucket, prefix="", start_after="", delimiter="", max_keys=1000):
+    # list the keys of a bucket in order, like S3 does
+    # returns the keys, the common prefixes, whether the listing is truncated and the
+    # marker to resume after, either the last key or the last common prefix
+    contents = []
+    common_prefixes = []
+    marker = None
+    with index_lock:
+        keys = get_bucket_keys(bucket)
+        i = bisect_left(keys, prefix)
+        if start_after:
+            if delimiter and start_after.endswith(delimiter) and start_after.startswith(prefix):
+                # resuming after a common prefix, skip all the keys it groups
+                i = max(i, bisect_left(keys, start_after + max_char))
+            else:
+                i = max(i, bisect_right(keys, start_after))
+
+        while i < len(keys) and len(contents) + len(common_prefixes) < max_keys:
+            key = keys[i]
+            if not key.startswith(prefix):
+                break
+            if delimiter:
+                end = key.find(delimiter, len(prefix))
+                if end >= 0:
+                    # group all the keys sharing this prefix and jump over them
+                    common_prefix = key[:end + len(delimiter)]
+                    common_prefixes.append(common_prefix)
+                    marker = common_prefix
+                    i = bisect_left(keys, common_prefix + max_char)
+                    continue
+            contents.append(key)
+            marker = key
+            i += 1
+
+        # a page of max_keys 0 lists nothing and has no marker to resume after, like S3 it
+        # is not truncated
+        is_truncated = marker is not None and i < len(keys) and keys[i].startswith(prefix)
+
+    return contents, common_prefixes, is_truncated, marker
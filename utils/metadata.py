@@ -0,0 +1,133 @@
+"""
+This module contains a cache of the metadata of the stored objects (size, mtime and ETag).
+Computing the ETag of an object means hashing the whole file, the cache makes listings
+cost a stat per object instead. The size of a compressed object (see utils/compression.py)
+is not the size of its file, it is cached too. An entry is only trusted if the mtime and the size of
+the file did not change since it was cached. The cache is kept in memory and persisted
+to disk so it survives restarts, by a background thread so a request never waits for it.
+"""
+
+import atexit
+import json
+import os
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+from utils.compression import object_digest
+from utils.files import save_json, storage_path
+
+from dotenv import load_dotenv
+load_dotenv()
+
+cache_path = os.getenv("S3_METADATA_CACHE", storage_path("metadata.json"))
+# maximum number of entries kept, the least recently used ones are evicted first
+max_entries = int(os.getenv("METADATA_CACHE_MAX_ENTRIES", "500000"))
+# persist the cache to disk after this many changes, and every this many seconds if it changed
+flush_every = int(os.getenv("METADATA_CACHE_FLUSH_EVERY", "100"))
+flush_seconds = float(os.getenv("METADATA_CACHE_FLUSH_SECONDS", "10"))
+
+# path -> [mtime_ns, file size, etag, object size]
+cache = OrderedDict()
+cache_lock = threading.Lock()
+save_lock = threading.Lock()
+pending_changes = 0
+# wakes the flush thread once flush_every changes are pending
+flush_needed = threading.Event()
+flush_thread = None
+
+
+def load_object_metadata():
+    try:
+        with open(cache_path, "r") as f:
+            entries = json.load(f)
+    except (OSError, ValueError):
+        return
+    with cache_lock:
+        cache.update(entries)
+        while len(cache) > max_entries:
+            cache.popitem(last=False)
+
+
+def save_object_metadata():
+    global pending_changes
+    with cache_lock:
+        if pending_changes == 0:
+            return
+        entries = dict(cache)
+        pending_changes = 0
+    with save_lock:
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        save_json(cache_path, entries)
+
+
+def run_flush():
+    while True:
+        flush_needed.wait(flush_seconds)
+        flush_needed.clear()
+        try:
+            save_object_metadata()
+        except Exception:
+            print("## Metadata cache | Save failed | ", traceback.format_exc())
+            # do not retry in a loop while the disk is full or the folder missing
+            time.sleep(flush_seconds)
+
+
+def record_change():
+    # must be called with cache_lock held
+    global pending_changes, flush_thread
+    pending_changes += 1
+    # the thread is only started by the process that changes the cache
+    if flush_thread is None:
+        flush_thread = threading.Thread(target=run_flush, name="metadata-cache", daemon=True)
+        flush_thread.start()
+    if pending_changes >= flush_every:
+        flush_needed.set()
+
+
+def put_object_metadata(file_path, e_tag, stat=None, size=None):
+    # called when an object is written, its ETag and size are known without reading the file again
+    # returns the stat of the file
+    file_path = os.path.normpath(file_path)
+    if stat is None:
+        stat = os.stat(file_path)
+    with cache_lock:
+        cache[file_path] = [stat.st_mtime_ns, stat.st_size, e_tag, stat.st_size if size is None else size]
+        cache.move_to_end(file_path)
+        if len(cache) > max_entries:
+            cache.popitem(last=False)
+        record_change()
+    return stat
+
+
+def delete_object_metadata(file_path):
+    file_path = os.path.normpath(file_path)
+    with cache_lock:
+        if cache.pop(file_path, None) is None:
+            return
+        record_change()
+
+
+def get_object_metadata(file_path, stat=None):
+    # return the size and the ETag of an object, reading it only if the cached entry is stale
+    file_path = os.path.normpath(file_path)
+    if stat is None:
+        stat = os.stat(file_path)
+    with cache_lock:
+        entry = cache.get(file_path)
+        # the entries cached before the objects could be compressed have no object size
+        if entry is not None and len(entry) == 4 and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+            cache.move_to_end(file_path)
+            return entry[3], entry[2]
+    e_tag, size = object_digest(file_path)
+    put_object_metadata(file_path, e_tag, stat, size)
+    return size, e_tag
+
+
+def get_object_etag(file_path, stat=None):
+    return get_object_metadata(file_path, stat)[1]
+
+
+load_object_metadata()
+atexit.register(save_object_metadata)
@@ -0,0 +1,136 @@
+"""
+This module contains the Prometheus metrics of the S3 API and of the syncs, served on /metrics:
+- s3_request_duration_seconds, per S3 operation, until the response headers are sent
+- s3_requests_total, per S3 operation and status code
+- s3_signature_verification_seconds
+- sync_stage_duration_seconds, per stage of the sync (see utils/timing.py)
+- sync_* gauges and counters of the sync worker of every tenant, read when scraped
+- object_cache_* counters and gauges of the hot object cache (see utils/object_cache.py)
+When the OpenTelemetry API is installed (pip install opentelemetry-api), the S3 requests
+and the sync stages are also traced as spans, exported by the configured SDK.
+"""
+
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+try:
+    from opentelemetry import trace
+    tracer = trace.get_tracer("s3-api-dvc-sync")
+except ImportError:
+    tracer = None
+
+metrics_content_type = CONTENT_TYPE_LATEST
+
+s3_request_duration = Histogram(
+    "s3_request_duration_seconds", "Duration of the S3 requests until the response headers are sent", ["operation"],
+)
+s3_requests = Counter("s3_requests", "S3 requests", ["operation", "status"])
+signature_verification_duration = Histogram(
+    "s3_signature_verification_seconds", "Duration of the AWS V4 signature verification",
+    buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01),
+)
+sync_stage_duration = Histogram(
+    "sync_stage_duration_seconds", "Duration of the stages of the sync", ["stage"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+
+
+@contextmanager
+def span(name):
+    # an OpenTelemetry span if the API is installed, nothing otherwise
+    if tracer is None:
+        yield
+        return
+    with tracer.start_as_current_span(name):
+        yield
+
+
+def observe_request(operation, status_code, duration):
+    s3_request_duration.labels(operation).observe(duration)
+    s3_requests.labels(operation, str(status_code)).inc()
+
+
+@contextmanager
+def timed_signature_verification():
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        signature_verification_duration.observe(time.perf_counter() - started_at)
+
+
+def observe_sync_stage(stage, duration):
+    sync_stage_duration.labels(stage).observe(duration)
+
+
+class TenantsCollector:
+    # reads the state of the sync workers when scraped instead of updating gauges on every change
+
+    def __init__(self, tenants):
+        self.tenants = tenants
+
+    def collect(self):
+        ready = GaugeMetricFamily("tenant_ready", "1 once the git repository of the tenant is ready", labels=["tenant"])
+        pending = GaugeMetricFamily(
+            "sync_pending_changes", "Changed objects waiting for the next sync", labels=["tenant"],
+        )
+        countdown = GaugeMetricFamily(
+            "sync_bundle_countdown", "Changes left before BUNDLE_COUNTDOWN is reached", labels=["tenant"],
+        )
+        oldest = GaugeMetricFamily(
+            "sync_oldest_pending_change_seconds", "Age of the oldest change waiting for a sync", labels=["tenant"],
+        )
+        in_progress = GaugeMetricFamily("sync_in_progress", "1 while a sync is running", labels=["tenant"])
+        last_latency = GaugeMetricFamily(
+            "sync_last_latency_seconds", "Delay between the first change and the end of the last sync",
+            labels=["tenant"],
+        )
+        completed = CounterMetricFamily("syncs_completed", "Successful syncs", labels=["tenant"])
+        failed = CounterMetricFamily("syncs_failed", "Failed syncs", labels=["tenant"])
+
+        for tenant in self.tenants:
+            worker = tenant.sync_worker
+            state = worker.metrics()
+            ready.add_metric([tenant.name], int(tenant.ready))
+            pending.add_metric([tenant.name], state["pending_changes"])
+            countdown.add_metric([tenant.name], max(worker.bundle_countdown - state["pending_changes"], 0))
+            oldest.add_metric([tenant.name], state["oldest_pending_change_seconds"])
+            in_progress.add_metric([tenant.name], int(state["sync_in_progress"]))
+            last_latency.add_metric([tenant.name], state["last_sync_latency_seconds"])
+            completed.add_metric([tenant.name], state["syncs_completed"])
+            failed.add_metric([tenant.name], state["syncs_failed"])
+
+        return [ready, pending, countdown, oldest, in_progress, last_latency, completed, failed]
+
+
+class ObjectCacheCollector:
+
+    def __init__(self, object_cache):
+        self.object_cache = object_cache
+
+    def collect(self):
+        cache = self.object_cache
+        hits = CounterMetricFamily("object_cache_hits", "GetObject and HeadObject requests served from memory")
+        hits.add_metric([], cache.hits)
+        misses = CounterMetricFamily("object_cache_misses", "GetObject and HeadObject requests that read the disk")
+        misses.add_metric([], cache.misses)
+        evictions = CounterMetricFamily("object_cache_evictions", "Objects evicted to stay within the byte budget")
+        evictions.add_metric([], cache.evictions)
+        size = GaugeMetricFamily("object_cache_bytes", "Bytes of the cached objects", value=cache.size)
+        objects = GaugeMetricFamily("object_cache_objects", "Cached objects", value=len(cache.entries))
+        return [hits, misses, evictions, size, objects]
+
+
+def register_tenants(tenants):
+    REGISTRY.register(TenantsCollector(tenants))
+
+
+def register_object_cache(object_cache):
+    REGISTRY.register(ObjectCacheCollector(object_cache))
+
+
+def metrics_content():
+    return generate_latest()
@@ -0,0 +1,104 @@
+"""
+This module contains an in-memory cache of the hot objects. Label Studio reads the
+annotations it just saved again, GetObject and HeadObject serve them from memory without
+touching the disk. The raw bytes, the mtime and the ETag of the objects up to
+OBJECT_CACHE_MAX_OBJECT_SIZE are kept, with the encoded bytes of the compressed objects
+(see utils/compression.py), the least recently used ones are evicted once the cache holds
+more than OBJECT_CACHE_MAX_BYTES (0 disables the cache):
+- PutObject caches the object it wrote, a GetObject missing the cache caches the object it read
+- an overwrite (PutObject, CompleteMultipartUpload) or a delete invalidates the object
+The writes of a key are serialized so the cache always holds the last written object.
+A compressed object is served from the cache as it is stored to the clients accepting its codec.
+The cache lives in the event loop, it is not shared between processes.
+"""
+
+import asyncio
+import os
+from collections import OrderedDict, namedtuple
+from contextlib import asynccontextmanager
+
+from dotenv import load_dotenv
+load_dotenv()
+
+max_bytes = int(os.getenv("OBJECT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+max_object_size = int(os.getenv("OBJECT_CACHE_MAX_OBJECT_SIZE", str(256 * 1024)))
+
+# mtime in seconds like os.stat, encoded and encoding are None if the object is not compressed
+CachedObject = namedtuple("CachedObject", ["data", "mtime", "e_tag", "encoded", "encoding"])
+
+
+def cached_size(cached):
+    return len(cached.data) + len(cached.encoded or b"")
+
+
+class ObjectCache:
+
+    def __init__(self, max_bytes, max_object_size):
+        self.max_bytes = max_bytes
+        self.max_object_size = min(max_object_size, max_bytes)
+        # (bucket, key) -> CachedObject
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # number of writes done, a read only caches what it read if no write happened meanwhile
+        self.writes = 0
+        # (bucket, key) -> [lock, number of writes holding or waiting for it]
+        self.key_locks = {}
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def cacheable(self, size):
+        return self.enabled and size <= self.max_object_size
+
+    def get(self, bucket, key):
+        if not self.enabled:
+            return None
+        cached = self.entries.get((bucket, key))
+        if cached is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end((bucket, key))
+        return cached
+
+    def put(self, bucket, key, cached):
+        # cached None or too large only invalidates the previous object of the key
+        self.invalidate(bucket, key)
+        if cached is None or not self.cacheable(len(cached.data)):
+            return
+        self.entries[(bucket, key)] = cached
+        self.size += cached_size(cached)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= cached_size(evicted)
+            self.evictions += 1
+
+    def invalidate(self, bucket, key):
+        cached = self.entries.pop((bucket, key), None)
+        if cached is not None:
+            self.size -= cached_size(cached)
+
+    @asynccontextmanager
+    async def writing(self, bucket, key):
+        # wraps a write of an object and the update of its cache entry, the writes of a
+        # key run one at a time so their cache updates happen in the order of the writes
+        if not self.enabled:
+            yield
+            return
+        key_lock = self.key_locks.setdefault((bucket, key), [asyncio.Lock(), 0])
+        key_lock[1] += 1
+        try:
+            async with key_lock[0]:
+                yield
+        finally:
+            self.writes += 1
+            key_lock[1] -= 1
+            if key_lock[1] == 0:
+                del self.key_locks[(bucket, key)]
+
+
+object_cache = ObjectCache(max_bytes, max_object_size)
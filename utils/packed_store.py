@@ -0,0 +1,372 @@
+"""
+This module contains the packed object store, an optional storage backend enabled with
+S3_STORAGE_BACKEND="packed". Label Studio annotations are a few KB each, storing each of
+them in its own file makes listings and dataset builds cost a stat and an open per object.
+The packed store appends the objects to large segment files instead:
+- every write appends a record (header, key, ETag, data) to the active segment, a
+  delete appends a tombstone, a new segment is started after S3_PACKED_SEGMENT_SIZE bytes
+- an in-memory index maps every key to its segment, offset, length, mtime, ETag and size
+  (the length of a compressed object is the length of its stored bytes, see utils/compression.py)
+- the index is snapshotted to disk, on startup the records written after the
+  snapshot are replayed from the segments
+- a background thread compacts the segments whose live records are less than
+  S3_PACKED_COMPACTION_MIN_LIVE_RATIO of their size by copying the live records to
+  the active segment
+Only the process that started the store writes to it, other processes (e.g. the
+benchmark) can load it to read the objects.
+The keys are grouped by folder like the files of the default backend, the sync reads
+the annotations of a folder sequentially, segment by segment.
+"""
+
+import atexit
+import json
+import os
+import struct
+import threading
+import time
+import traceback
+from collections import namedtuple
+
+from utils.files import copy_exact, data_folder, save_json, storage_path
+
+from dotenv import load_dotenv
+load_dotenv()
+
+storage_backend = os.getenv("S3_STORAGE_BACKEND", "files")
+packed_folder = os.getenv("S3_PACKED_FOLDER", storage_path("packed"))
+segment_size = int(os.getenv("S3_PACKED_SEGMENT_SIZE", str(64 * 1024 * 1024)))
+compaction_min_live_ratio = float(os.getenv("S3_PACKED_COMPACTION_MIN_LIVE_RATIO", "0.5"))
+maintenance_seconds = float(os.getenv("S3_PACKED_MAINTENANCE_SECONDS", "60"))
+
+# operation, key length, ETag length, data length, size of the object, mtime in nanoseconds
+record_header = struct.Struct(">BHHQQQ")
+put_operation = 1
+delete_operation = 2
+
+# offset is the offset of the data of the object in the segment, size is the size of the object
+PackedRecord = namedtuple("PackedRecord", ["segment", "offset", "length", "mtime_ns", "e_tag", "size"])
+
+
+def split_key(bucket, key):
+    # "bucket/dir/name" -> ("bucket/dir", "name")
+    folder, _, name = f"{bucket}/{key}".rpartition("/")
+    return folder, name
+
+
+def record_size(folder, name, e_tag, length):
+    return record_header.size + len(f"{folder}/{name}".encode("utf-8")) + len(e_tag.encode("utf-8")) + length
+
+
+class PackedStore:
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.snapshot_path = f"{folder}/index.json"
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        # folder ("bucket/dir") -> name -> PackedRecord
+        self.folders = {}
+        # segment -> size of the segment and size of its live records
+        self.segment_sizes = {}
+        self.live_bytes = {}
+        self.active = 0
+        self.active_file = None
+        # compacted segments, deleted once a snapshot no longer references them, at the
+        # next maintenance so the reads in flight can finish
+        self.retired = []
+        self.releasable = []
+        # compacted segments left by a crash, deleted when the store is started
+        self.stray = []
+        self.dirty = False
+        self.load()
+
+    def segment_path(self, segment):
+        return f"{self.folder}/segment-{segment:08d}.log"
+
+    def segment_ids(self):
+        return sorted(
+            int(name[len("segment-"):-len(".log")])
+            for name in os.listdir(self.folder)
+            if name.startswith("segment-") and name.endswith(".log")
+        )
+
+    def load(self):
+        # load the snapshot and replay the records written after it
+        with self.lock:
+            os.makedirs(self.folder, exist_ok=True)
+            try:
+                with open(self.snapshot_path, "r") as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                snapshot = {"segments": {}, "folders": {}}
+
+            self.folders = {
+                folder: {name: PackedRecord(*record) for name, record in entries.items()}
+                for folder, entries in snapshot["folders"].items()
+            }
+            known = {int(segment): size for segment, size in snapshot["segments"].items()}
+            self.segment_sizes = {}
+            self.retired = []
+            self.releasable = []
+            self.stray = []
+            replayed = False
+            for segment in self.segment_ids():
+                if segment in known:
+                    replayed |= self.replay(segment, known[segment])
+                elif segment > max(known, default=-1):
+                    replayed |= self.replay(segment, 0)
+                else:
+                    # compacted, the snapshot no longer references it
+                    self.stray.append(segment)
+
+            self.live_bytes = {segment: 0 for segment in self.segment_sizes}
+            for folder, entries in self.folders.items():
+                for name, record in entries.items():
+                    self.live_bytes[record.segment] = (
+                        self.live_bytes.get(record.segment, 0)
+                        + record_size(folder, name, record.e_tag, record.length)
+                    )
+
+            self.active = max(self.segment_sizes, default=0)
+            self.segment_sizes.setdefault(self.active, 0)
+            self.live_bytes.setdefault(self.active, 0)
+            self.dirty = replayed
+
+    def replay(self, segment, offset):
+        # must be called with the lock held, applies the records of a segment from offset
+        # a record cut by a crash (or still being written) ends the segment
+        # returns True if records were replayed
+        path = self.segment_path(segment)
+        size = os.path.getsize(path)
+        replayed = False
+        with open(path, "rb") as f:
+            f.seek(offset)
+            while offset < size:
+                header = f.read(record_header.size)
+                if len(header) < record_header.size:
+                    break
+                operation, name_length, e_tag_length, length, object_size, mtime_ns = record_header.unpack(header)
+                end = offset + record_header.size + name_length + e_tag_length + length
+                if end > size:
+                    break
+                full_name = f.read(name_length).decode("utf-8")
+                e_tag = f.read(e_tag_length).decode("utf-8")
+                folder, _, name = full_name.rpartition("/")
+                if operation == put_operation:
+                    data_offset = end - length
+                    self.folders.setdefault(folder, {})[name] = PackedRecord(
+                        segment, data_offset, length, mtime_ns, e_tag, object_size
+                    )
+                else:
+                    self.folders.get(folder, {}).pop(name, None)
+                f.seek(end)
+                offset = end
+                replayed = True
+        self.segment_sizes[segment] = offset
+        return replayed
+
+    def append_record(self, operation, folder, name, e_tag, mtime_ns, length, size=0, source=None):
+        # must be called with the lock held, returns the offset of the data of the record
+        if self.segment_sizes[self.active] >= segment_size:
+            self.active_file.close()
+            self.active += 1
+            self.active_file = open(self.segment_path(self.active), "ab")
+            self.segment_sizes[self.active] = 0
+            self.live_bytes[self.active] = 0
+
+        name_bytes = f"{folder}/{name}".encode("utf-8")
+        e_tag_bytes = e_tag.encode("utf-8")
+        start = self.segment_sizes[self.active]
+        try:
+            self.active_file.write(
+                record_header.pack(operation, len(name_bytes), len(e_tag_bytes), length, size, mtime_ns)
+                + name_bytes + e_tag_bytes
+            )
+            if source is not None:
+                copy_exact(source, self.active_file, length)
+            self.active_file.flush()
+        except BaseException:
+            # never leave a partial record in the segment
+            self.active_file.truncate(start)
+            raise
+        self.segment_sizes[self.active] = start + record_header.size + len(name_bytes) + len(e_tag_bytes) + length
+        self.dirty = True
+        return self.segment_sizes[self.active] - length
+
+    def set_record(self, folder, name, record):
+        # must be called with the lock held, record None removes the key
+        entries = self.folders.setdefault(folder, {})
+        old = entries.get(name)
+        if old is not None:
+            self.live_bytes[old.segment] -= record_size(folder, name, old.e_tag, old.length)
+        if record is None:
+            entries.pop(name, None)
+            if not entries:
+                del self.folders[folder]
+        else:
+            entries[name] = record
+            self.live_bytes[record.segment] += record_size(folder, name, record.e_tag, record.length)
+
+    def put(self, bucket, key, source, length, e_tag, size):
+        # append length bytes read from source as the object of key
+        folder, name = split_key(bucket, key)
+        mtime_ns = time.time_ns()
+        with self.lock:
+            offset = self.append_record(put_operation, folder, name, e_tag, mtime_ns, length, size, source)
+            record = PackedRecord(self.active, offset, length, mtime_ns, e_tag, size)
+            self.set_record(folder, name, record)
+        return record
+
+    def put_file(self, bucket, key, file_path, e_tag, size):
+        with open(file_path, "rb") as source:
+            return self.put(bucket, key, source, os.fstat(source.fileno()).st_size, e_tag, size)
+
+    def delete(self, bucket, key):
+        # returns False if the key did not exist
+        folder, name = split_key(bucket, key)
+        with self.lock:
+            if name not in self.folders.get(folder, {}):
+                return False
+            self.append_record(delete_operation, folder, name, "", time.time_ns(), 0)
+            self.set_record(folder, name, None)
+        return True
+
+    def get(self, bucket, key):
+        folder, name = split_key(bucket, key)
+        return self.folders.get(folder, {}).get(name)
+
+    def keys(self, bucket):
+        # all the keys of a bucket, sorted
+        keys = []
+        with self.lock:
+            for folder, entries in self.folders.items():
+                if folder == bucket:
+                    keys.extend(entries)
+                elif folder.startswith(f"{bucket}/"):
+                    prefix = folder[len(bucket) + 1:]
+                    keys.extend(f"{prefix}/{name}" for name in entries)
+        keys.sort()
+        return keys
+
+    def scan(self, physical_folder):
+        # name -> PackedRecord of the objects of a folder of the default backend layout
+        folder = os.path.relpath(physical_folder, data_folder).replace(os.sep, "/")
+        with self.lock:
+            return dict(self.folders.get(folder, {}))
+
+    def read_objects(self, records):
+        # name -> stored data of the given records, read sequentially segment by segment
+        data = {}
+        ordered = sorted(records.items(), key=lambda item: (item[1].segment, item[1].offset))
+        f = None
+        segment = None
+        try:
+            for name, record in ordered:
+                if record.segment != segment:
+                    if f is not None:
+                        f.close()
+                    segment = record.segment
+                    f = open(self.segment_path(segment), "rb")
+                f.seek(record.offset)
+                data[name] = f.read(record.length)
+        finally:
+            if f is not None:
+                f.close()
+        return data
+
+    def compact(self):
+        # copy the live records of the segments that are mostly garbage to the active segment
+        with self.lock:
+            candidates = [
+                segment for segment, size in self.segment_sizes.items()
+                if segment != self.active and segment not in self.retired and segment not in self.releasable
+                and self.live_bytes.get(segment, 0) < compaction_min_live_ratio * size
+            ]
+        for segment in candidates:
+            with self.lock:
+                live = [
+                    (folder, name, record)
+                    for folder, entries in self.folders.items()
+                    for name, record in entries.items()
+                    if record.segment == segment
+                ]
+            live.sort(key=lambda item: item[2].offset)
+            with open(self.segment_path(segment), "rb") as source:
+                for folder, name, record in live:
+                    with self.lock:
+                        # skip the objects written or deleted since the scan
+                        if self.folders.get(folder, {}).get(name) is not record:
+                            continue
+                        source.seek(record.offset)
+                        offset = self.append_record(
+                            put_operation, folder, name, record.e_tag, record.mtime_ns, record.length,
+                            record.size, source,
+                        )
+                        self.set_record(folder, name, record._replace(segment=self.active, offset=offset))
+            with self.lock:
+                self.retired.append(segment)
+                # the next snapshot must stop referencing the segment
+                self.dirty = True
+            print(f"## Packed store | Compacted segment {segment}, {len(live)} objects moved")
+
+    def delete_retired(self):
+        with self.lock:
+            releasable, self.releasable = self.releasable, []
+            for segment in releasable:
+                del self.segment_sizes[segment]
+                self.live_bytes.pop(segment, None)
+        for segment in releasable:
+            os.unlink(self.segment_path(segment))
+
+    def save_snapshot(self):
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                if self.active_file is not None:
+                    self.active_file.flush()
+                excluded = list(self.retired)
+                snapshot = {
+                    "segments": {
+                        str(segment): size for segment, size in self.segment_sizes.items()
+                        if segment not in excluded and segment not in self.releasable
+                    },
+                    "folders": {folder: dict(entries) for folder, entries in self.folders.items()},
+                }
+                self.dirty = False
+            try:
+                save_json(self.snapshot_path, snapshot)
+            except BaseException:
+                self.dirty = True
+                raise
+            with self.lock:
+                # the segments compacted before the snapshot are no longer needed
+                self.retired = [segment for segment in self.retired if segment not in excluded]
+                self.releasable.extend(excluded)
+
+    def run_maintenance(self):
+        while True:
+            time.sleep(maintenance_seconds)
+            try:
+                self.delete_retired()
+                self.compact()
+                self.save_snapshot()
+            except Exception:
+                print("## Packed store | Maintenance failed | ", traceback.format_exc())
+
+    def start(self):
+        # the process serving the requests owns the store: it appends to the active
+        # segment, saves the snapshots and compacts the segments
+        with self.lock:
+            for segment in self.stray:
+                os.unlink(self.segment_path(segment))
+            self.stray = []
+            path = self.segment_path(self.active)
+            self.active_file = open(path, "ab")
+            # drop a record cut by a crash
+            self.active_file.truncate(self.segment_sizes[self.active])
+        atexit.register(self.save_snapshot)
+        threading.Thread(target=self.run_maintenance, name="packed-store", daemon=True).start()
+
+
+packed_store = PackedStore(packed_folder) if storage_backend == "packed" else None
@@ -0,0 +1,38 @@
+from utils.git import git_pull, git_commit_push
+from utils.dvc import (
+    dvc_update_dataset_file, dvc_commit_push, close_dvc_repo, dataset_digest, dataset_is_synced, save_synced_digest,
+)
+from utils.timing import timed_stage
+
+
+# a sync of one tenant, config holds the tenant configuration
+def sync_eventually(config, physical_data_path):
+    git_folder = config.get("GIT_FOLDER")
+
+    # skip everything if the annotations did not change since the last successful sync
+    with timed_stage("digest"):
+        digest = dataset_digest(physical_data_path, config)
+    if dataset_is_synced(digest, config):
+        print("## No Changes | Skipping Sync...")
+        return
+
+    print("## Syncing...")
+    # git pull the repo
+    with timed_stage("git_pull"):
+        if git_pull(config):
+            # the .dvc files may have changed, reopen the dvc repo
+            close_dvc_repo(git_folder)
+    # update the dataset file
+    with timed_stage("dataset_update"):
+        dvc_update_dataset_file(physical_data_path, config)
+    # commit and push the changes with dvc
+    dvc_commit_push(config)
+    # commit the .dvc file if it changed and push it with the commits of the previous
+    # syncs that failed to push, if any
+    with timed_stage("git_commit_push"):
+        pushed = git_commit_push(config)
+    if pushed:
+        print("## Sync Done | Changes Committed and Pushed")
+    else:
+        print("## No Changes | Skipping Git Commit and Push...")
+    save_synced_digest(digest, config)
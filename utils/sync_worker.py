@@ -0,0 +1,128 @@
+"""
+This module contains the sync worker, a single long-lived thread running the syncs.
+Changes are coalesced: a change arriving while a sync is running is picked up by the
+next sync instead of being dropped, so the last changes of a burst are always synced.
+A sync starts when either
+- BUNDLE_COUNTDOWN changes are pending and no change arrived for SYNC_DEBOUNCE_SECONDS
+- SYNC_MAX_BATCH changes are pending
+- the oldest pending change is SYNC_MAX_LATENCY_SECONDS old
+"""
+
+import threading
+import time
+import traceback
+
+
+class SyncWorker:
+
+    def __init__(self, sync, bundle_countdown=10, debounce=10, max_latency=60, max_batch=1000):
+        # sync is called with the physical path of the last changed object
+        self.sync = sync
+        self.bundle_countdown = bundle_countdown
+        self.debounce = debounce
+        self.max_latency = max_latency
+        self.max_batch = max_batch
+
+        self.condition = threading.Condition()
+        self.pending_changes = 0
+        self.first_change_at = None
+        self.last_change_at = None
+        self.physical_data_path = None
+        # after a failure, wait before retrying
+        self.retry_at = 0.0
+
+        self.sync_in_progress = False
+        self.syncs_completed = 0
+        self.syncs_failed = 0
+        self.last_sync_batch = 0
+        self.last_sync_duration = 0.0
+        self.last_sync_latency = 0.0
+
+        self.thread = threading.Thread(target=self.run, name="sync-worker", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def notify(self, physical_data_path):
+        # record a change, never blocks the caller
+        with self.condition:
+            now = time.monotonic()
+            if self.pending_changes == 0:
+                self.first_change_at = now
+            self.pending_changes += 1
+            self.last_change_at = now
+            self.physical_data_path = physical_data_path
+            self.condition.notify()
+
+    def seconds_until_due(self):
+        # must be called with the condition held, None means nothing to sync
+        if self.pending_changes == 0:
+            return None
+        now = time.monotonic()
+        if now < self.retry_at:
+            return self.retry_at - now
+        if self.pending_changes >= self.max_batch:
+            return 0
+        deadline = self.first_change_at + self.max_latency
+        if self.pending_changes >= self.bundle_countdown:
+            deadline = min(deadline, self.last_change_at + self.debounce)
+        return max(deadline - now, 0)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    wait = self.seconds_until_due()
+                    if wait == 0:
+                        break
+                    self.condition.wait(wait)
+
+                # take all the pending changes, new ones will be synced next time
+                batch = self.pending_changes
+                first_change_at = self.first_change_at
+                physical_data_path = self.physical_data_path
+                self.pending_changes = 0
+                self.first_change_at = None
+                self.sync_in_progress = True
+
+            started_at = time.monotonic()
+            print(f"## Sync | {batch} changes, oldest {started_at - first_change_at:.1f}s ago")
+            try:
+                self.sync(physical_data_path)
+                failed = False
+            except Exception:
+                print("## Sync failed | ", traceback.format_exc())
+                failed = True
+
+            with self.condition:
+                self.sync_in_progress = False
+                self.last_sync_duration = time.monotonic() - started_at
+                if failed:
+                    # put the changes back, they will be retried after max_latency
+                    self.syncs_failed += 1
+                    self.retry_at = time.monotonic() + self.max_latency
+                    if self.pending_changes == 0:
+                        self.first_change_at = first_change_at
+                        self.last_change_at = first_change_at
+                        self.physical_data_path = physical_data_path
+                    self.pending_changes += batch
+                else:
+                    self.syncs_completed += 1
+                    self.last_sync_batch = batch
+                    self.last_sync_latency = time.monotonic() - first_change_at
+
+    def metrics(self):
+        with self.condition:
+            oldest = 0.0
+            if self.first_change_at is not None:
+                oldest = time.monotonic() - self.first_change_at
+            return {
+                "pending_changes": self.pending_changes,
+                "oldest_pending_change_seconds": oldest,
+                "sync_in_progress": self.sync_in_progress,
+                "syncs_completed": self.syncs_completed,
+                "syncs_failed": self.syncs_failed,
+                "last_sync_batch": self.last_sync_batch,
+                "last_sync_duration_seconds": self.last_sync_duration,
+                "last_sync_latency_seconds": self.last_sync_latency,
+            }
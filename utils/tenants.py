@@ -0,0 +1,121 @@
+"""
+This module contains the tenant registry. A tenant is one Label Studio project: its
+access key, its buckets, its git repository, its DvC remote and its sync worker.
+Without TENANTS_FILE there is a single tenant configured by the environment.
+TENANTS_FILE is a JSON list of objects setting the keys of tenant_keys below (the
+credentials, the git and DvC settings and the sync worker settings), keys that are not
+set fall back to the environment, and an optional "BUCKETS" list restricting the buckets
+of the tenant, e.g.
+[
+    {"NAME": "cats", "AWS_ACCESS_KEY_ID": "...", "AWS_SECRET_ACCESS_KEY": "...", "BUCKETS": ["cats"],
+     "GIT_FOLDER": "./storage/git/cats", "GIT_REPO": "https://...", "DVC_BUCKET_NAME": "cats-dataset"}
+]
+The other settings (storage, compression, caches, pools) are read once by the process
+from the environment, a tenant setting one of them is rejected.
+Syncs of all the tenants run on a shared pool of SYNC_POOL_SIZE threads.
+"""
+
+import json
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.git import init_git_repo
+from utils.sync import sync_eventually
+from utils.sync_worker import SyncWorker
+
+from dotenv import load_dotenv
+load_dotenv()
+
+bootstrap_retry_seconds = float(os.getenv("BOOTSTRAP_RETRY_SECONDS", "30"))
+
+# the settings read from the configuration of a tenant
+tenant_keys = {
+    "NAME", "BUCKETS", "AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY",
+    "GIT_REPO", "GIT_BRANCH", "GIT_FOLDER", "GIT_PAT_NAME",
+    "DVC_BACKEND", "DVC_REMOTE_NAME", "DVC_CLOUD_STORAGE_PROVIDER", "DVC_BUCKET_NAME",
+    "DVC_S3_ENDPOINT", "DVC_S3_ACCESS_KEY_ID", "DVC_S3_SECRET_ACCESS_KEY",
+    "DVC_GOOGLE_APPLICATION_CREDENTIALS", "DVC_GCP_SERVICE_ACCOUNT_KEY",
+    "DVC_DATASET", "DVC_DATASET_FORMAT", "DVC_DATASET_COMPRESSION", "DVC_DATASET_SHARDS", "DVC_DATASET_INDEX",
+    "BUNDLE_COUNTDOWN", "SYNC_DEBOUNCE_SECONDS", "SYNC_MAX_LATENCY_SECONDS", "SYNC_MAX_BATCH",
+}
+
+
+class Tenant:
+
+    def __init__(self, config, sync_pool):
+        self.config = config
+        self.name = config.get("NAME", "default")
+        self.access_key_id = config.get("AWS_ACCESS_KEY_ID")
+        self.secret_access_key = config.get("AWS_SECRET_ACCESS_KEY")
+        # None means every bucket
+        self.buckets = set(config["BUCKETS"]) if config.get("BUCKETS") else None
+        self.sync_pool = sync_pool
+        # True once the git repository is ready to sync
+        self.ready = False
+        self.sync_worker = SyncWorker(
+            self.sync,
+            bundle_countdown=int(config.get("BUNDLE_COUNTDOWN")),
+            debounce=float(config.get("SYNC_DEBOUNCE_SECONDS", "10")),
+            max_latency=float(config.get("SYNC_MAX_LATENCY_SECONDS", "60")),
+            max_batch=int(config.get("SYNC_MAX_BATCH", "1000")),
+        )
+
+    def owns_bucket(self, bucket):
+        return self.buckets is None or bucket in self.buckets
+
+    def sync(self, physical_data_path):
+        # the worker of the tenant waits while the sync runs on the shared pool
+        self.sync_pool.submit(sync_eventually, self.config, physical_data_path).result()
+
+    def bootstrap(self):
+        # clone the repository, retrying until it works, then start syncing
+        while True:
+            try:
+                print(f"## INIT | Tenant {self.name}")
+                init_git_repo(self.config)
+                break
+            except Exception:
+                print(f"## INIT | Tenant {self.name} failed, retrying in {bootstrap_retry_seconds}s | ", traceback.format_exc())
+                time.sleep(bootstrap_retry_seconds)
+        self.ready = True
+        # the changes received while bootstrapping are synced now
+        self.sync_worker.start()
+
+    def start(self):
+        # bootstrap in the background, the objects can be stored before the tenant is ready
+        threading.Thread(target=self.bootstrap, name=f"bootstrap-{self.name}", daemon=True).start()
+
+
+def load_tenants():
+    tenants_file = os.getenv("TENANTS_FILE")
+    if tenants_file:
+        with open(tenants_file, "r") as f:
+            entries = json.load(f)
+    else:
+        entries = [{}]
+    for entry in entries:
+        # a process setting in a tenant would be silently ignored
+        unknown = sorted(set(entry) - tenant_keys)
+        if unknown:
+            raise ValueError(f"tenant {entry.get('NAME')} sets {', '.join(unknown)}, which can not be set per tenant")
+
+    sync_pool = ThreadPoolExecutor(int(os.getenv("SYNC_POOL_SIZE", "2")), thread_name_prefix="sync")
+    tenants = [Tenant({**os.environ, **entry}, sync_pool) for entry in entries]
+
+    # tenants must not share credentials, buckets or git folders
+    for attribute in ["access_key_id", "name"]:
+        values = [getattr(tenant, attribute) for tenant in tenants]
+        if len(values) != len(set(values)):
+            raise ValueError(f"tenants must have distinct {attribute}")
+    git_folders = [tenant.config.get("GIT_FOLDER") for tenant in tenants]
+    if len(git_folders) != len(set(git_folders)):
+        raise ValueError("tenants must have distinct GIT_FOLDER")
+    if len(tenants) > 1:
+        buckets = [bucket for tenant in tenants for bucket in (tenant.buckets or [None])]
+        if None in buckets or len(buckets) != len(set(buckets)):
+            raise ValueError("tenants must each have their own BUCKETS")
+
+    return tenants
@@ -0,0 +1,21 @@
+import time
+from contextlib import contextmanager
+
+from utils.metrics import observe_sync_stage, span
+
+# stage name -> duration in seconds of its last run
+stage_timings = {}
+
+
+@contextmanager
+def timed_stage(stage):
+    # time a stage of the sync and log its duration
+    started_at = time.perf_counter()
+    try:
+        with span(f"sync {stage}"):
+            yield
+    finally:
+        duration = time.perf_counter() - started_at
+        stage_timings[stage] = duration
+        observe_sync_stage(stage, duration)
+        print(f"## Sync | {stage} took {duration:.3f}s")
@@ -0,0 +1,53 @@
+"""
+This module contains the transformation of Label Studio annotations into importable tasks.
+It is kept free of heavy imports because the dataset builder runs it in worker processes.
+"""
+
+import json
+
+from utils.compression import decode_object, read_object
+
+# orjson is much faster than json, use it when it is installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+json_codec = "orjson" if orjson is not None else "json"
+
+
+def json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(value):
+    # returns bytes
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value).encode("utf-8")
+
+
+def transform_label_studio_annotation_to_task(annotation):
+    label_studio_task = annotation["task"]
+    del annotation["task"]
+    label_studio_task["annotations"] = []
+    label_studio_task["annotations"].append(annotation)
+    return label_studio_task
+
+
+def transform_annotation(data):
+    # returns the task id and the serialized task
+    # transform label studio annotation to an importable task
+    ls_task = transform_label_studio_annotation_to_task(json_loads(data))
+    return ls_task.get("id"), json_dumps(ls_task)
+
+
+def transform_annotation_file(file_path):
+    return transform_annotation(read_object(file_path))
+
+
+def transform_stored_annotation(data):
+    # the annotation as read from the packed store, compressed or not
+    return transform_annotation(decode_object(data))